@@ -4,19 +4,26 @@
 # Tested on sklearn, matplotlib, and some others.                      #
 # Still under development...                                           #
 ########################################################################
-from sklearn.cluster import KMeans
-import rockstar
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
+from MyTools import *
+from STAR import STAR
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import argparse
-import random
 
 def ArgumentParse():
     parser=argparse.ArgumentParser(description = "Clustering micrograph based on beam image shift")
     parser.add_argument("--star", metavar = "*.star", type = str, help = "Provide the filename of MetaData, must contain image_shift_x,image_shift_y,MicrographName columns")
     parser.add_argument("--meta", required = True, metavar = "*.csv", type = str, help = "Provide the star file, MicrographName will be inferred if not contained")
     parser.add_argument("--o", default= "Classify_Result", metavar = '*.*', type = str, help = "Provide the filename of ouput")
-    parser.add_argument('--k', default = 0, type = int,help= "How many classes classified into")
+    parser.add_argument('--k', default = 0, type = int,help= "How many classes classified into, chosen automatically by default")
+    parser.add_argument('--k_range', default = [2, 20], nargs = 2, type = int, metavar = ("MIN", "MAX"), help= "Range of class numbers tried when --k is not given")
+    parser.add_argument('--method', default = "kmeans", choices = ["kmeans", "minibatch", "grid"], help= "kmeans, MiniBatchKMeans for large datasets, or snapping the beam shifts to a grid of --grid spacing")
+    parser.add_argument('--grid', default = 0, type = float, help= "Spacing of the beam shift pattern for --method grid, in the units of the scaled beam shifts")
+    parser.add_argument('--jobs', default = 1, type = int, help= "Number of processes used to try the class numbers")
     parser.add_argument('--bad', default = "", type = str,help= "Specify file containing bad images")
     #If default is specified, the variable will created anyway...
     parser.add_argument('--save_plot', action = 'store_true',help= "Save plot of classification")
@@ -39,35 +46,48 @@ def format_DataFrame(filename):
 def remove_file_suffix():
     pass
 
-def classify(df, class_nr):
-    unlabeled = df[["image_shift_x", "image_shift_y"]]
-    kmeans = KMeans(n_clusters = class_nr) 
-    kmeans.fit(unlabeled)
-    result = kmeans.fit_predict(unlabeled)
+def get_model(class_nr, method = "kmeans"):
+    if method == "minibatch":
+        return MiniBatchKMeans(n_clusters = class_nr, batch_size = 4096, n_init = 3, random_state = 0)
+    return KMeans(n_clusters = class_nr, n_init = 10, random_state = 0)
+
+def classify(df, class_nr, method = "kmeans", grid = 0):
+    unlabeled = df[["image_shift_x", "image_shift_y"]].to_numpy()
+    if method == "grid":
+        # Multi-shot collection puts the beam shifts on a regular pattern, snap each one to its grid point
+        cells = np.round(unlabeled / grid).astype(np.int64)
+        result = pd.factorize(pd.MultiIndex.from_arrays([cells[:, 0], cells[:, 1]]), sort = True)[0]
+    else:
+        result = get_model(class_nr, method).fit_predict(unlabeled)
     df["OpticsGroups"] = result
     return df
 
-def plot_unlabeled(df):
-    #plt = df.plot.scatter(x = "image_shift_x", y = "image_shift_y",c = "black")
-    #filename = ".".join(input_file.split(".")[:-1]) +"_unlabeled.png" 
-    plt.scatter(df.image_shift_x, df.image_shift_y, c = "black")
-    plt.xlabel("image_shift_x")
-    plt.ylabel("image_shift_y")
-    plt.show()
-    return int(raw_input("\nPlease specify class number:    "))
+def score_class_number(unlabeled, class_nr, method = "kmeans"):
+    """Silhouette score of one class number, on a sample of 10000 micrographs at most"""
+    labels = get_model(class_nr, method).fit_predict(unlabeled)
+    return silhouette_score(unlabeled, labels, sample_size = min(10000, unlabeled.shape[0]), random_state = 0)
+
+def choose_class_number(df, k_min, k_max, method = "kmeans", jobs = 1):
+    """Try every class number from k_min to k_max, in parallel, and take the one of the best silhouette score"""
+    unlabeled = df[["image_shift_x", "image_shift_y"]].to_numpy()
+    k_list = list(range(max(2, k_min), min(k_max, unlabeled.shape[0] - 1) + 1))
+    if not k_list:
+        print_error("Not enough micrographs to classify")
+    with ProcessPoolExecutor(max_workers = jobs) as pool:
+        scores = list(pool.map(score_class_number, [unlabeled] * len(k_list), k_list, [method] * len(k_list)))
+    for k, score in zip(k_list, scores):
+        print_info("Class number {:>3}: silhouette score {:.4f}".format(k, score))
+    best = k_list[int(np.argmax(scores))]
+    print_info("Class number {} is used".format(best))
+    return best
 
 def get_color_palette(num):
-    color_palette = []
-    while True:
-        color_palette.append((random.randint(0,100) / 100.0, random.randint(0,100) / 100.0, random.randint(0,100) / 100.0))
-        if len(set(color_palette)) == num:
-            break
-    return list(set(color_palette))
+    cmap = plt.get_cmap("tab20" if num <= 20 else "hsv")
+    return cmap(np.arange(num) / (20.0 if num <= 20 else num))
 
 def plot_labeled(df, output, cls_nr, save_plot = False):
     color_palette = get_color_palette(cls_nr)
-    for idx in df.index.values:
-        plt.scatter(df.loc[idx, "image_shift_x"], df.loc[idx, "image_shift_y"], c = color_palette[df.loc[idx, "OpticsGroups"]])
+    plt.scatter(df["image_shift_x"], df["image_shift_y"], c = color_palette[df["OpticsGroups"].to_numpy()], s = 4)
     plt.xlabel("image_shift_x")
     plt.ylabel("image_shift_y")
     if save_plot:
@@ -80,7 +100,7 @@ def df2csv(df, output, micrograph_name_only = False):
     g = df.groupby("OpticsGroups")
     for cls_nr, mics_subset in g:
         filename = output + ".Group" + str(cls_nr + 1)
-        df["MicrographName"].to_csv(path_or_buf = filename, index = False, header = False)
+        mics_subset["MicrographName"].to_csv(path_or_buf = filename, index = False, header = False)
 
 if __name__ == "__main__":
 
@@ -89,25 +109,30 @@ if __name__ == "__main__":
     try:
         meta_df = format_DataFrame(args.meta)
     except IOError:
-        print "Failed to read the csv file, exiting"    
-        sys.exit(-1)
+        print_error("Failed to read the csv file")
 
     if args.bad :
         try:
             with open(args.bad) as fp:
-                bad_list = filter(None, fp.read().split("\n"))
+                bad_list = [m for m in fp.read().split("\n") if m]
         except IOError:
-            print "File Permission Problem, no filtration can to be done ..."
+            print_warning("File Permission Problem, no filtration can to be done ...")
         else:
             mask = meta_df["MicrographName"].isin(bad_list)
             meta_df = meta_df[~mask]
 
-    if not args.k:
-        class_number = plot_unlabeled(meta_df)
+    if args.method == "grid":
+        if args.grid <= 0:
+            print_error("--grid needs to be specified for --method grid")
+        meta_df = classify(meta_df, 0, method = "grid", grid = args.grid)
+        class_number = meta_df["OpticsGroups"].max() + 1
+        print_info("The beam shifts fall on {} grid points".format(class_number))
     else:
-        class_number = args.k
-
-    meta_df = classify(meta_df, class_number)
+        if not args.k:
+            class_number = choose_class_number(meta_df, args.k_range[0], args.k_range[1], method = args.method, jobs = args.jobs)
+        else:
+            class_number = args.k
+        meta_df = classify(meta_df, class_number, method = args.method)
 
     if args.save_plot:
         plot_labeled(meta_df, args.o, class_number, save_plot = args.save_plot)
@@ -115,10 +140,9 @@ if __name__ == "__main__":
         plot_labeled(meta_df, args.o, class_number)
 
     if args.star:
-        star_df = rockstar.STAR(args.star)
-        meta_df["OpticsGroups"] = meta_df["OpticsGroups"] + 1
-        meta_df.rename(columns={"MicrographName":"rlnMicrographName","OpticsGroups":"rlnOpticsGroup"}, inplace = True)
-        new_star = star_df.append_columns(meta_df[['rlnMicrographName','rlnOpticsGroup']], on='rlnMicrographName')
-        rockstar.df2star(new_star, args.o + ".star")
+        star = STAR(args.star, columns = ["rlnMicrographName", "rlnOpticsGroup"])
+        groups = pd.Series(meta_df["OpticsGroups"].to_numpy(), index = meta_df["MicrographName"])
+        star.assign_optics_groups(groups, on = "rlnMicrographName")
+        star.to_star(args.o + ".star")
     else:
         df2csv(meta_df, args.o)
@@ -0,0 +1,232 @@
+#! /usr/bin/python
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#   Synthetic star/cs/mrcs files and the cases timed by benchmarks/      #
+############################################################################
+import argparse
+import json
+import os
+import resource
+import runpy
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+from MyTools import *
+from STAR import STAR, get_column_formats, write_star_rows
+from StageProfiler import get_memory_mb
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PARTICLES_PER_MICROGRAPH = 200
+CLASS_NR = 50
+BOX_SIZE = 128
+
+OPTICS_31 = """
+# version 30001
+
+data_optics
+
+loop_
+_rlnOpticsGroupName #1
+_rlnOpticsGroup #2
+_rlnMicrographOriginalPixelSize #3
+_rlnVoltage #4
+_rlnSphericalAberration #5
+_rlnAmplitudeContrast #6
+_rlnImagePixelSize #7
+_rlnImageSize #8
+_rlnImageDimensionality #9
+opticsGroup1  1  0.830000  300.000000  2.700000  0.100000  1.660000  {}  2
+
+
+# version 30001
+""".format(BOX_SIZE)
+
+# Cases timed by benchmarks/, "mode:" cases run rockstar.py, the others a STAR method.
+# The class averages of the RELION 3.0 star files are recentered with this downscale factor.
+CASES = ["mode:info", "mode:subset_star", "mode:subset_cs", "mode:exclude", "mode:hr",
+         "parse", "keep_rows", "drop_rows", "human_recenter", "remove_duplicates", "to_star"]
+DOWNSCALE = 2
+
+def ArgumentParse():
+    parser = argparse.ArgumentParser(description = "Run one case of benchmarks/ and print its timings as json")
+    parser.add_argument("--run_case", required = True, nargs = 3, metavar = ("CASE", "STAR", "OUTPUT"))
+    return parser.parse_args()
+
+#Synthetic data
+def make_particles(n, version = "3.1", seed = 0):
+    """Particles of n // 200 micrographs, 50 classes and a random pose, indexed by rlnImageName"""
+    rng = np.random.default_rng(seed)
+    mic_nr = max(1, n // PARTICLES_PER_MICROGRAPH)
+    mic = np.sort(rng.integers(0, mic_nr, n))
+    first = np.searchsorted(mic, np.arange(mic_nr))
+    slice_nr = np.arange(n) - first[mic]
+    mics = np.array(["MotionCorr/job002/Movies/mic_{:06d}.mrc".format(i) for i in range(mic_nr)], dtype = object)
+    stacks = np.array(["Extract/job004/Movies/mic_{:06d}.mrcs".format(i) for i in range(mic_nr)], dtype = object)
+    slices = np.array(["{:06d}@".format(i + 1) for i in range(slice_nr.max() + 1)], dtype = object)
+
+    defocus = rng.uniform(5000, 30000, mic_nr)[mic]
+    df = pd.DataFrame({"rlnImageName": slices[slice_nr] + stacks[mic]})
+    df["rlnCoordinateX"] = rng.uniform(BOX_SIZE, 5760 - BOX_SIZE, n)
+    df["rlnCoordinateY"] = rng.uniform(BOX_SIZE, 4092 - BOX_SIZE, n)
+    df["rlnClassNumber"] = rng.integers(1, CLASS_NR + 1, n)
+    df["rlnAnglePsi"] = rng.uniform(-180, 180, n)
+    df["rlnMicrographName"] = mics[mic]
+    df["rlnDefocusU"] = defocus + rng.uniform(0, 500, n)
+    df["rlnDefocusV"] = defocus - rng.uniform(0, 500, n)
+    df["rlnDefocusAngle"] = rng.uniform(-180, 180, n)
+    if version == "3.0":
+        df["rlnOriginX"] = rng.normal(0, 3, n)
+        df["rlnOriginY"] = rng.normal(0, 3, n)
+        df["rlnVoltage"] = 300.0
+        df["rlnSphericalAberration"] = 2.7
+        df["rlnAmplitudeContrast"] = 0.1
+        df["rlnDetectorPixelSize"] = 5.0
+        df["rlnMagnification"] = 30120.48
+    else:
+        df["rlnOpticsGroup"] = 1
+        df["rlnOriginXAngst"] = rng.normal(0, 5, n)
+        df["rlnOriginYAngst"] = rng.normal(0, 5, n)
+    return df.set_index("rlnImageName")
+
+def write_star(filename, df, version = "3.1"):
+    with open(filename, "w", buffering = 1 << 22) as fp:
+        if version == "3.1":
+            fp.write(OPTICS_31 + "\ndata_particles\n\nloop_\n")
+        else:
+            fp.write("\ndata_\n\nloop_\n")
+        for i, col in enumerate([df.index.name] + df.columns.tolist()):
+            fp.write("_{} #{}\n".format(col, i + 1))
+        write_star_rows(fp, [df], get_column_formats(df))
+
+def write_cs(filename, df):
+    """cryosparc particles of df, only the fields read by rockstar.py and a few usual ones"""
+    names = df.index.to_series().str.split("@", n = 1, expand = True)
+    cs = np.zeros(df.shape[0], dtype = [("uid", "<u8"), ("blob/path", "S64"), ("blob/idx", "<u4"), \
+        ("blob/shape", "<u4", (2,)), ("blob/psize_A", "<f4")])
+    cs["uid"] = np.arange(df.shape[0])
+    cs["blob/path"] = ("J1/imported/" + names[1].str.split("/").str[-1]).str.encode("utf-8").to_numpy()
+    cs["blob/idx"] = names[0].astype(np.int64).to_numpy() - 1
+    cs["blob/shape"] = BOX_SIZE
+    cs["blob/psize_A"] = 1.66
+    with open(filename, "wb") as fp:
+        np.save(fp, cs)
+
+def write_mrcs(filename, n = CLASS_NR, box = BOX_SIZE, seed = 0):
+    """Class averages with a gaussian blob off the box center, float32 MRC2014"""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:box, :box]
+    centers = box // 2 + rng.uniform(-box / 8, box / 8, (n, 2))
+    images = np.exp(-((xx - centers[:, 0, None, None]) ** 2 + (yy - centers[:, 1, None, None]) ** 2) / (2 * (box / 12) ** 2))
+    images = (images + rng.normal(0, 0.05, images.shape)).astype("<f4")
+    header = np.zeros(256, dtype = "<i4")
+    header[:4] = (box, box, n, 2)
+    header[7:10] = (box, box, n)
+    header[16:19] = (1, 2, 3)
+    raw = bytearray(header.tobytes())
+    raw[208:212] = b"MAP "
+    raw[212:214] = b"\x44\x44"
+    with open(filename, "wb") as fp:
+        fp.write(bytes(raw))
+        fp.write(images.tobytes())
+
+def generate(folder, n, version, seed = 0):
+    """Write the synthetic files of n particles into folder unless they are there, return their names"""
+    prefix = os.path.join(folder, "n{}_v{}_s{}".format(n, version.replace(".", ""), seed))
+    files = {k: prefix + suffix for k, suffix in (("star", ".star"), ("subset_star", "_subset.star"), \
+        ("subset_cs", "_subset.cs"), ("exclude", "_exclude.star"), ("mrcs", "_classes.mrcs"))}
+    if all(os.path.exists(f) for f in files.values()):
+        return files
+    print_info("Generating {} particles of RELION {} in {}".format(n, version, folder))
+    df = make_particles(n, version, seed)
+    write_star(files["star"], df, version)
+    write_star(files["subset_star"], df.iloc[::2], version)
+    write_cs(files["subset_cs"], df.iloc[::2])
+    mics = df["rlnMicrographName"].unique()
+    write_star(files["exclude"], df[df["rlnMicrographName"].isin(mics[::10])], version)
+    write_mrcs(files["mrcs"], seed = seed)
+    return files
+
+#Timings
+def get_peak_rss():
+    """Peak resident memory of this process in MB"""
+    if get_memory_mb("VmHWM"):
+        return get_memory_mb("VmHWM")
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024.0 ** (2 if sys.platform == "darwin" else 1)
+
+def run_case(case, star_file, output, rockstar_args = None):
+    """
+        Run one STAR method on star_file, or rockstar.py with rockstar_args, in this process and print
+        the seconds taken and the peak memory as the last line of json
+    """
+    timings = {}
+    t0 = time.perf_counter()
+    try:
+        if case.startswith("mode:"):
+            sys.argv = [os.path.join(HERE, "rockstar.py")] + rockstar_args
+            runpy.run_path(sys.argv[0], run_name = "__main__")
+        else:
+            star = STAR(star_file)
+            t1 = time.perf_counter()
+            timings["load"] = t1 - t0
+            if case == "keep_rows":
+                names = star.get_particle_names()[::2]
+                t1 = time.perf_counter()
+                star.keep_rows(names, inplace = True)
+            elif case == "drop_rows":
+                mics = list(dict.fromkeys(star.get_column_content("rlnMicrographName", uniq = False)))[::10]
+                t1 = time.perf_counter()
+                star.drop_rows("rlnMicrographName", mics, inplace = True)
+            elif case == "human_recenter":
+                d = {str(c): (1.5, -2.0) for c in range(1, CLASS_NR + 1)}
+                star.human_recenter(BOX_SIZE // 2, BOX_SIZE // 2, 5760 - BOX_SIZE // 2, 4092 - BOX_SIZE // 2, d, \
+                    downscale = DOWNSCALE)
+            elif case == "remove_duplicates":
+                star.remove_duplicates(BOX_SIZE / 2, score = "rlnDefocusU", inplace = True)
+            elif case == "to_star":
+                star.to_star(output)
+            else:
+                t1 = t0
+            timings["op"] = time.perf_counter() - t1
+    finally:
+        timings["peak_rss_mb"] = get_peak_rss()
+        print("\n" + json.dumps(timings))
+
+def get_rockstar_args(case, files, output):
+    if case == "mode:info":
+        return ["info", "--i", files["star"]]
+    elif case == "mode:subset_star":
+        return ["subset", "--i", files["star"], "--subset", files["subset_star"], "--o", output]
+    elif case == "mode:subset_cs":
+        return ["subset", "--i", files["star"], "--subset", files["subset_cs"], "--o", output]
+    elif case == "mode:exclude":
+        return ["exclude", "--i", files["star"], "--exclude", files["exclude"], "--o", output]
+    elif case == "mode:hr":
+        return ["hr", "--i", files["star"], "--mrcs", files["mrcs"], "--micsx", "5760", "--micsy", "4092", \
+            "--auto", "--downscale", str(DOWNSCALE), "--o", output]
+
+def run_case_process(case, files, output):
+    """
+        Run a case in a fresh process and return the timings printed by run_case. The memory is measured
+        by the child itself, the peak RSS reported by the parent would include the memory of this process.
+    """
+    if os.path.exists(output):
+        os.remove(output)
+    cmd = [sys.executable, os.path.abspath(__file__), "--run_case", case, files["star"], output]
+    if case.startswith("mode:"):
+        cmd += ["--"] + get_rockstar_args(case, files, output)
+    proc = subprocess.run(cmd, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, stdin = subprocess.DEVNULL, \
+        cwd = HERE, universal_newlines = True)
+    if proc.returncode:
+        raise RuntimeError("{} failed:\n{}".format(case, proc.stdout))
+    return json.loads(proc.stdout.strip().split("\n")[-1])
+
+if __name__ == "__main__":
+
+    # The arguments of rockstar.py follow "--" when a mode is timed
+    rockstar_args = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    sys.argv = sys.argv[:len(sys.argv) - len(rockstar_args) - bool(rockstar_args)]
+    args = ArgumentParse()
+    run_case(*args.run_case, rockstar_args = rockstar_args)
@@ -0,0 +1,45 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#           Reading MRC/MRCS images without RELION                         #
+############################################################################
+import os
+import numpy as np
+from MyTools import *
+
+# MRC2014 data modes supported by the reader
+MRC_MODES = {0: np.int8, 1: np.int16, 2: np.float32, 6: np.uint16, 12: np.float16}
+
+def read_mrc_header(filename):
+    """
+        Parse the 1024-byte main header of a mrc/mrcs file and return a dictionary with nx, ny, nz,
+        mode, nsymbt (extended header size in bytes), the numpy dtype of the pixels and the offset
+        of the pixel data.
+    """
+    try:
+        with open(filename, "rb") as fp:
+            raw = fp.read(1024)
+    except IOError:
+        print_error("Failed to read {}".format(filename))
+    if len(raw) < 1024:
+        print_error("{} is too short to be a mrc file".format(filename))
+
+    # The machine stamp at byte 212 tells the byte order, 0x11 means big endian
+    endian = ">" if raw[212] == 0x11 else "<"
+    words = np.frombuffer(raw, dtype = endian + "i4", count = 56)
+    nx, ny, nz, mode = (int(v) for v in words[:4])
+    if mode not in MRC_MODES:
+        print_error("Unsupported mrc data mode {} in {}".format(mode, filename))
+    header = {"nx": nx, "ny": ny, "nz": nz, "mode": mode, "nsymbt": int(words[23]),
+              "dtype": np.dtype(MRC_MODES[mode]).newbyteorder(endian)}
+    header["offset"] = 1024 + header["nsymbt"]
+    expected = header["offset"] + nx * ny * nz * header["dtype"].itemsize
+    if os.path.getsize(filename) < expected:
+        print_error("{} is shorter than its header says".format(filename))
+    return header
+
+def read_mrc_data(filename, header = None):
+    """Memory-map the pixels of a mrc/mrcs file as a (nz, ny, nx) array, nothing is read until used"""
+    if header is None:
+        header = read_mrc_header(filename)
+    return np.memmap(filename, dtype = header["dtype"], mode = "r", offset = header["offset"], \
+        shape = (header["nz"], header["ny"], header["nx"]))
@@ -5,10 +5,14 @@
 
 import re
 import os
-import math
+import json
+import numpy as np
 import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from MyTools import *
+from MrcTools import read_mrc_header, read_mrc_data
 
 # General Relion Tools
 def is_relion_callable():
@@ -40,15 +44,17 @@ def get_relion_version():
         print_error("Failed to get the relion version")
 
 def get_image_dimensions(image, dimension = "y"):
-    """Get dimension info of movies, micrograph, particles_stack, and class_average_stack"""
-    dim = {}
-    cmd_output = subprocess.getstatusoutput("relion_image_handler --i " + image + " --stats")
-    idx = re.findall(r"\d+@", cmd_output[1])
-    if idx:
-        dim["n"] = len(idx)
+    """
+        Get dimension info of movies, micrograph, particles_stack, and class_average_stack.
+        Only the mrc header is read. Like RELION, a .mrcs file is a stack of n 2D images and
+        any other file a single image or volume.
+    """
+    header = read_mrc_header(image)
+    dim = {"x": header["nx"], "y": header["ny"]}
+    if image.endswith(".mrcs"):
+        dim["z"], dim["n"] = 1, header["nz"]
     else:
-        dim["n"] = 1
-    dim["x"], dim["y"], dim["z"] = re.findall(r"\(x,y,z,n\)= (\d+) x (\d+) x (\d+) x 1", cmd_output[1])[0]
+        dim["z"], dim["n"] = header["nz"], 1
 
     result = []
     for d in dimension:
@@ -149,40 +155,127 @@ def get_pipeline_input(filename = "default_pipeline.star"):
     content.reverse()
     return content
 
-def get_parent_job(nr, content):
-    """ This function works for 3.0 and 3.1"""
-    try:
-        p = {}
-        c = "".join(content)
-        p["extract_cmd"] = "Extract/job{:03}".format(nr)
-        p["autopk_cmd"] = re.findall("(AutoPick/job\d{3}).*" + p["extract_cmd"], c)[0]
-        p["autopk_prefix"] = p["autopk_cmd"]
-        p["ctf_cmd"] = re.findall("(CtfFind/job\d{3}).*" + p["autopk_cmd"], c)[0]
-        result = re.findall("(MotionCorr/job\d{3}).*" + p["ctf_cmd"],c)
-        if result:
-            p["mc_cmd"] = result[0]
-            p["import_cmd"] = re.findall("(Import/job\d{3}).*" + p["mc_cmd"], c)[0]
-        else:
-            p["import_cmd"] = re.findall("(Import/job\d{3}).*" + p["ctf_cmd"], c)[0]
-    except IndexError:
+_pipeline_graphs = {}
+
+def get_job_name(path):
+    """Job folder of a node or process, e.g. "CtfFind/job003/micrographs_ctf.star" -> "CtfFind/job003" """
+    return "/".join(path.split("/")[:2])
+
+class PipelineGraph():
+    """
+        The jobs of a RELION project and how they are connected, parsed from default_pipeline.star.
+        parents/children map every job ("Type/jobNNN") to the jobs it reads from/is read by, in the
+        order of the pipeline file, so lineage queries only follow the edges of the lineage.
+    """
+
+    def __init__(self, filename = "default_pipeline.star", lines = None):
+        self.parents = {}
+        self.children = {}
+        producer = {}
+        input_edges = []
+        block = ""
+        if lines is None:
+            with open(filename) as fp:
+                lines = fp.readlines()
+        for ln in lines:
+            ln = ln.strip()
+            if ln.startswith("data_"):
+                block = ln
+                continue
+            if not ln or ln.startswith("loop_") or ln.startswith("_") or ln.startswith("#"):
+                continue
+            fields = ln.split()
+            if len(fields) < 2:
+                continue
+            if block == "data_pipeline_input_edges":
+                input_edges.append((fields[0], get_job_name(fields[1])))
+            elif block == "data_pipeline_output_edges":
+                producer[fields[1]] = get_job_name(fields[0])
+
+        for node, job in input_edges:
+            parent = producer.get(node, get_job_name(node))
+            self.parents.setdefault(job, []).append(parent)
+            self.children.setdefault(parent, []).append(job)
+
+    def get_parent(self, job, job_type):
+        """The latest job of job_type the job reads from, None if there is none"""
+        for parent in reversed(self.parents.get(get_job_name(job), [])):
+            if parent.split("/")[0] == job_type:
+                return parent
+        return None
+
+    def upstream(self, job):
+        """All the jobs the job depends on, nearest first"""
+        return self._walk(job, self.parents)
+
+    def downstream(self, job):
+        """All the jobs depending on the job, nearest first"""
+        return self._walk(job, self.children)
+
+    def _walk(self, job, edges):
+        seen, queue, result = {get_job_name(job)}, deque([get_job_name(job)]), []
+        while queue:
+            for nxt in edges.get(queue.popleft(), []):
+                if nxt not in seen:
+                    seen.add(nxt)
+                    queue.append(nxt)
+                    result.append(nxt)
+        return result
+
+def get_pipeline_graph(filename = "default_pipeline.star"):
+    """The PipelineGraph of filename, parsed again only when the file has been modified"""
+    key = os.path.abspath(filename)
+    mtime = os.path.getmtime(filename)
+    if key not in _pipeline_graphs or _pipeline_graphs[key][0] != mtime:
+        _pipeline_graphs[key] = (mtime, PipelineGraph(filename))
+    return _pipeline_graphs[key][1]
+
+def get_parent_job(nr, content = None):
+    """ This function works for 3.0 and 3.1
+        content is the output of get_pipeline_input, by default default_pipeline.star is used.
+    """
+    if content is None:
+        graph = get_pipeline_graph()
+    else:
+        graph = PipelineGraph(lines = reversed(content))
+    p = {}
+    p["extract_cmd"] = "Extract/job{:03}".format(nr)
+    p["autopk_cmd"] = graph.get_parent(p["extract_cmd"], "AutoPick")
+    p["autopk_prefix"] = p["autopk_cmd"]
+    p["ctf_cmd"] = graph.get_parent(p["autopk_cmd"] or "", "CtfFind")
+    mc = graph.get_parent(p["ctf_cmd"] or "", "MotionCorr")
+    if mc:
+        p["mc_cmd"] = mc
+    p["import_cmd"] = graph.get_parent(mc or p["ctf_cmd"] or "", "Import")
+    if None in p.values():
         print_error("Missing jobs")
-    
+
     print_dict(p)
     return p
 
-def collect_relion_commands(nr, p):
+_job_notes = {}
+
+def read_job_note(jb):
+    """The stripped lines of the note.txt of a job folder, read again only when note.txt has been modified"""
+    filename = os.path.join(jb, "note.txt")
+    assert os.path.isfile(filename), filename + " doesn't exist."
+    mtime = os.path.getmtime(filename)
+    if filename not in _job_notes or _job_notes[filename][0] != mtime:
+        with open(filename) as fp:
+            _job_notes[filename] = (mtime, [ln.rstrip("\n").rstrip(" ").lstrip(" ") for ln in fp])
+    return _job_notes[filename][1]
+
+def collect_relion_commands(nr, p, jobs = 8):
     """ This function is used to read the note.txt and retrieve the command under certain job folders.
         It only works for relion 3.1
+        The note.txt files are read by a pool of jobs threads, each job folder once per modification.
     """
 
     def collect_relion_command(jb, keyword = "relion_"):
         cmd = ""
-        filename = os.path.join(jb, "note.txt")
-        assert os.path.isfile(filename), filename + " doesn't exist."
-        with open(filename) as fp:
-            for ln in fp.readlines():
-                if keyword in ln:
-                    cmd = ln.rstrip("\n").rstrip(" ").lstrip(" ")
+        for ln in read_job_note(jb):
+            if keyword in ln:
+                cmd = ln
         if cmd:
             return cmd
         else:
@@ -194,6 +287,8 @@ def collect_relion_commands(nr, p):
     para_dict["skip_link"] = "#"
     para_dict["extract_job"] = "job{:03}".format(nr)
 
+    with ThreadPoolExecutor(max_workers = jobs) as pool:
+        list(pool.map(read_job_note, set(p.values())))
     for k,v in p.items():
         if k == "autopk_prefix":
             para_dict[k] = collect_relion_command(v, keyword = "echo")
@@ -230,10 +325,51 @@ def relion_display_parser(mrcs, class_number, scale = '1'):
 
     return d
 
+def auto_class_centers(mrcs, sigma = 1.0):
+    """
+        Find the center of every class average without relion_display. The pixels brighter than
+        mean + sigma * std of their image are weighted by how much brighter they are, and the center of
+        mass of these weights is returned the same way as relion_display_parser does, i.e. as offsets
+        (x, y) from the box center. Empty classes are discarded.
+    """
+    images = np.asarray(read_mrc_data(mrcs), dtype = np.float64)
+    n, ny, nx = images.shape
+    flat = images.reshape(n, -1)
+    threshold = flat.mean(axis = 1) + sigma * flat.std(axis = 1)
+    weights = np.maximum(images - threshold[:, None, None], 0)
+    total = weights.sum(axis = (1, 2))
+    center_x = (weights.sum(axis = 1) * np.arange(nx)).sum(axis = 1) / np.where(total > 0, total, 1) - nx // 2
+    center_y = (weights.sum(axis = 2) * np.arange(ny)).sum(axis = 1) / np.where(total > 0, total, 1) - ny // 2
+
+    d = {}
+    for i in range(n):
+        cls = str(i + 1)
+        if total[i] > 0:
+            d[cls] = (round(float(center_x[i]), 2), round(float(center_y[i]), 2))
+            print_info("Center of cls {} is {}, {}".format(cls, d[cls][0], d[cls][1]))
+        else:
+            print_info("Class {} is discarded".format(cls))
+    return d
+
+def save_class_centers(d, filename):
+    """Save the centers from relion_display_parser/auto_class_centers, so that they can be replayed"""
+    with open(filename, "w") as fp:
+        json.dump(d, fp, indent = 1)
+    print_info("Saved class centers to {}".format(filename))
+
+def load_class_centers(filename):
+    try:
+        with open(filename) as fp:
+            d = json.load(fp)
+    except (IOError, ValueError):
+        print_error("Failed to read class centers from {}".format(filename))
+    print_info("Replaying {} class centers from {}".format(len(d), filename))
+    return {str(k): (v[0], v[1]) for k, v in d.items()}
+
 def get_offset_xy(psi, dx, dy):
-    """This function records and parses the relion_display output after mouse click on the class average"""
-    cos_val = math.cos( float(psi) / 180 * 3.14 )
-    sin_val = math.sin( float(psi) / 180 * 3.14 )
+    """Rotate the offset (dx, dy) by the in-plane angle psi, works on scalars and numpy arrays alike"""
+    cos_val = np.cos(np.deg2rad(psi))
+    sin_val = np.sin(np.deg2rad(psi))
     offsetx = dx * cos_val + dy * sin_val
     offsety = dy * cos_val - dx * sin_val
     return (offsetx, offsety)
@@ -0,0 +1,41 @@
+#! /usr/bin/python
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#     Thin client of the rockstar server, same command line as rockstar    #
+############################################################################
+import json
+import os
+import socket
+import sys
+
+def get_socket_path():
+    """Unix socket of the rockstar server, $ROCKSTAR_SOCKET or ~/.rockstar.sock"""
+    return os.environ.get("ROCKSTAR_SOCKET", os.path.expanduser("~/.rockstar.sock"))
+
+def send_request(argv, path):
+    """Run the rockstar command line argv on the server, print its output and return its exit code"""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(path)
+    with s, s.makefile("rb") as fp:
+        s.sendall((json.dumps({"argv": argv, "cwd": os.getcwd()}) + "\n").encode("utf-8"))
+        for ln in fp:
+            message = json.loads(ln.decode("utf-8"))
+            if "code" in message:
+                return message["code"]
+            sys.stdout.write(message["output"])
+            sys.stdout.flush()
+    # The server went away in the middle of the request
+    return 1
+
+#Main
+
+if __name__ == '__main__':
+
+    path = get_socket_path()
+    try:
+        code = send_request(sys.argv[1:], path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        # No server, run rockstar here
+        rockstar = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rockstar.py")
+        os.execv(sys.executable, [sys.executable, rockstar] + sys.argv[1:])
+    sys.exit(code)
@@ -0,0 +1,173 @@
+#! /usr/bin/python
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#     rockstar server keeping the parsed star files in memory              #
+############################################################################
+import argparse
+import io
+import json
+import os
+import socket
+import socketserver
+import time
+import traceback
+from collections import OrderedDict
+from contextlib import redirect_stdout, redirect_stderr
+from MyTools import *
+from RockClient import get_socket_path
+from StarHeader import read_star_header
+
+class StarMemoryCache():
+    """
+        Parsed star files kept in memory, keyed by path, size, modification time and the way the file
+        was opened (idx, columns). The least recently used ones are dropped once they take more than
+        max_bytes. Every request gets a copy (STAR.copy) and the cached star file stays untouched.
+    """
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._stars = OrderedDict()
+        self._sizes = {}
+
+    def load(self, filename, **kwargs):
+        from STAR import STAR
+        # A file too big for the cache is read as asked, e.g. streamed with chunksize
+        if os.path.getsize(filename) > self._max_bytes:
+            return STAR(filename, **kwargs)
+        kwargs["chunksize"] = None
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        options = tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in kwargs.items()
+                               if k not in ("chunksize", "cache_dir", "cache_size")))
+        key = (path, options)
+        if key in self._stars and self._stars[key][0] == (st.st_size, st.st_mtime_ns):
+            self._stars.move_to_end(key)
+            print_info("{} is kept in memory by the server".format(filename))
+            return self._stars[key][1].copy()
+        star = STAR(filename, **kwargs)
+        self._stars[key] = ((st.st_size, st.st_mtime_ns), star)
+        self._sizes[key] = star.get_memory_usage()
+        self._stars.move_to_end(key)
+        while sum(self._sizes.values()) > self._max_bytes and len(self._stars) > 1:
+            old, _ = self._stars.popitem(last = False)
+            del self._sizes[old]
+        return star.copy()
+
+    def get_size(self):
+        return sum(self._sizes.values())
+
+    def __len__(self):
+        return len(self._stars)
+
+class SocketWriter(io.TextIOBase):
+    """stdout/stderr of a request, sent to the client as it is printed"""
+    def __init__(self, conn):
+        self._conn = conn
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        if s:
+            try:
+                self._conn.sendall((json.dumps({"output": s}) + "\n").encode("utf-8"))
+            except OSError:
+                pass
+        return len(s)
+
+def run_request(request, writer):
+    """Run one rockstar command line, returns its exit code"""
+    import rockstar
+    code = 0
+    with redirect_stdout(writer), redirect_stderr(writer):
+        try:
+            os.chdir(request["cwd"])
+            args = rockstar.ArgumentParse(request["argv"])
+            if args.profile or args.cprofile:
+                print_warning("--profile and --cprofile are not supported by the server, run rockstar.py instead")
+                args.profile = args.cprofile = None
+            if args.mode == "hr" and not args.auto and not (args.clicks and os.path.exists(args.clicks)):
+                print_error("The server can't show the class averages, use --auto or a saved --clicks file")
+            if args.mode == "hr" and not args.downscale and read_star_header(args.i)["version"] == "3.0":
+                print_error("The server can't ask for the downscale factor of a RELION 3.0 star file, use --downscale")
+            rockstar.main(args)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except Exception:
+            traceback.print_exc()
+            code = 1
+    return code
+
+class RockRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+        except ValueError:
+            return
+        start = time.perf_counter()
+        code = run_request(request, SocketWriter(self.request))
+        cache = self.server.cache
+        print_info("{} -> {} in {:.3f}s, {} star files in memory ({:.1f} MB)".format(" ".join(request["argv"]), \
+            code, time.perf_counter() - start, len(cache), cache.get_size() / 1024.0 ** 2))
+        try:
+            self.wfile.write((json.dumps({"code": code}) + "\n").encode("utf-8"))
+        except OSError:
+            pass
+
+class RockServer(socketserver.UnixStreamServer):
+    """
+        Runs the rockstar command lines sent by RockClient.py one after another, in this process, so
+        that the star files parsed once are reused by the next requests.
+    """
+    def __init__(self, path, max_bytes):
+        import rockstar
+        self.cache = StarMemoryCache(max_bytes)
+        rockstar.star_loader = self.cache.load
+        self._cwd = os.getcwd()
+        super().__init__(path, RockRequestHandler)
+        os.chmod(path, 0o600)
+
+    def finish_request(self, request, client_address):
+        try:
+            super().finish_request(request, client_address)
+        finally:
+            os.chdir(self._cwd)
+
+def is_server_running(path):
+    """True if a server answers on the socket path"""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+def ArgumentParse():
+    parser = argparse.ArgumentParser(formatter_class = argparse.RawDescriptionHelpFormatter, \
+        description = '\033[31mrockstar server, keeps the parsed star files in memory for RockClient.py\033[0m')
+    parser.add_argument("--socket", required = False, default = get_socket_path(), metavar = 'PATH', type = str, \
+        help = "Unix socket to listen on, RockClient.py finds it through $ROCKSTAR_SOCKET (default ~/.rockstar.sock)")
+    parser.add_argument("--memory", required = False, default = 4096, metavar = 'MB', type = int, \
+        help = "Memory for the parsed star files, the least recently used ones are dropped first")
+    return parser.parse_args()
+
+#Main
+
+if __name__ == '__main__':
+
+    args = ArgumentParse()
+    if os.path.exists(args.socket):
+        if is_server_running(args.socket):
+            print_error("A server is already running on {}".format(args.socket))
+        os.remove(args.socket)
+    server = RockServer(args.socket, args.memory * 1024 ** 2)
+    print_info("rockstar server listening on {}, stop it with Ctrl-C".format(args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+        print_info("Server stopped")
@@ -3,12 +3,217 @@
 #           Tested on Python 3.8.8 Pandas v0.22.0  Numpy v1.19.1           #
 #           Tested on RELION 3.0 / 3.1, Cryosparc 2.9                      #
 ############################################################################
-import argparse
+import copy
+import io
+import itertools
 import os
 import pandas as pd
 import numpy as np
-import sys
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from RelionTools import *
+from StarCache import load_sidecar, save_sidecar
+from StageProfiler import stage
+from StarHeader import read_star_header, get_optics_table, get_optics_groups, get_star_index
+from StarStream import get_compression, open_star_file
+
+# Value types of the RELION labels that are always written the same way.
+# Labels not listed here are left to pandas to guess.
+RELION_INT_LABELS = {"rlnClassNumber", "rlnOpticsGroup", "rlnGroupNumber", "rlnRandomSubset",
+                     "rlnNrOfSignificantSamples", "rlnImageSize", "rlnImageDimensionality",
+                     "rlnNrOfFrames", "rlnHelicalTubeID", "rlnCtfDataAreCtfPremultiplied"}
+RELION_STR_LABELS = {"rlnImageName", "rlnMicrographName", "rlnOpticsGroupName", "rlnMicrographMovieName",
+                     "rlnOriginalImageName", "rlnReconstructImageName", "rlnCtfImage", "rlnMicrographMetadata",
+                     "rlnMicrographGainName", "rlnMicrographDefectFile", "rlnMtfFileName", "rlnGroupName"}
+
+def get_label_dtypes(columns):
+    """Map the _rln labels of a loop to the dtypes used for parsing"""
+    dtypes = {}
+    for col in columns:
+        if col in RELION_INT_LABELS:
+            dtypes[col] = np.int64
+        elif col in RELION_STR_LABELS or col.endswith("Name"):
+            dtypes[col] = str
+    return dtypes
+
+def encode_particle_keys(names, stacks = None):
+    """
+        Pack particle names "NNNNNN@path/stack.mrcs" into int64 keys, so that particle sets can be joined
+        with numpy sorting instead of hashing millions of long strings:
+            bits 32-62: id of the stack path, i.e. its position in stacks
+            bits 28-31: number of digits before the "@"
+            bits  0-27: slice number
+        Two names get the same key exactly when they are the same string.
+        Returns (keys, stacks). When stacks is given, the stack ids refer to it and names from any other
+        stack get the key -1. Returns None if the names don't follow the NNNNNN@stack pattern.
+    """
+    parts = pd.Series(np.asarray(names, dtype = object), dtype = object)
+    if not parts.map(type).eq(str).all():
+        return None
+    if parts.empty:
+        return np.empty(0, np.int64), pd.Index([], dtype = object) if stacks is None else stacks
+    parts = parts.str.partition("@")
+    digits = parts[0]
+    if not (parts[1] == "@").all() or not digits.str.fullmatch("[0-9]{1,8}").all():
+        return None
+    codes, labels = pd.factorize(parts[2])
+    if stacks is None:
+        stacks = pd.Index(labels, dtype = object)
+    else:
+        codes = stacks.get_indexer(labels)[codes] if len(stacks) else np.full(len(codes), -1)
+    keys = (codes.astype(np.int64) << 32) | (digits.str.len().to_numpy(np.int64) << 28) | digits.astype(np.int64).to_numpy()
+    keys[codes < 0] = -1
+    return keys, stacks
+
+def get_column_formats(df):
+    """
+        printf style format of one line of the particles loop, index first. The format comes from the
+        labels (see get_label_dtypes), so that every chunk of a streamed star file is written the same
+        way: integer labels as integers and the other numeric _rln labels as floats with 6 decimals.
+        Numbers of labels unknown to RELION are written as integers when they are whole numbers.
+    """
+    dtypes = get_label_dtypes(df.columns)
+    fmts = ["%s"]
+    for col in df.columns:
+        if dtypes.get(col) is str or df[col].dtype.kind not in "iuf":
+            fmts.append("%s")
+        elif dtypes.get(col) is np.int64 or not col.startswith("rln"):
+            fmts.append("%d")
+        else:
+            fmts.append("%.6f")
+    return " ".join(fmts)
+
+def format_float(value):
+    """Floats are written with 6 decimals, values too small for 6 decimals with 6 significant digits"""
+    return ("%.6g" if 0 < abs(value) < 0.001 else "%.6f") % value
+
+def format_number(value):
+    return "%d" % value if float(value).is_integer() else format_float(value)
+
+def format_star_rows(df, fmt):
+    """
+        Format the rows of a DataFrame into the text of a star file loop. Floats too small for 6 decimals
+        and the floats of integer columns are written value by value, so that the text doesn't depend on
+        how the rows were cut into chunks.
+    """
+    if not df.shape[0]:
+        return ""
+    fmts = fmt.split(" ")
+    columns = [df[col].tolist() for col in df.columns]
+    for i, col in enumerate(df.columns):
+        kind = df[col].dtype.kind
+        if fmts[i + 1] == "%s" or kind in "iu":
+            continue
+        elif kind != "f":
+            fmts[i + 1] = "%s"
+        elif fmts[i + 1] == "%d":
+            columns[i] = list(map(format_number, columns[i]))
+            fmts[i + 1] = "%s"
+        elif ((np.abs(df[col].to_numpy()) > 0) & (np.abs(df[col].to_numpy()) < 0.001)).any():
+            columns[i] = list(map(format_float, columns[i]))
+            fmts[i + 1] = "%s"
+    rows = zip(df.index.tolist(), *columns)
+    return "\n".join(map(" ".join(fmts).__mod__, rows)) + "\n"
+
+def write_star_rows(fp, chunks, fmt, jobs = 1, block_size = 100000):
+    """
+        Write DataFrame chunks into an open star file and return the number of rows written. The chunks are
+        cut into blocks of block_size rows, with jobs > 1 the blocks are formatted in a process pool, at
+        most 2 * jobs blocks at a time.
+    """
+    blocks = (chunk.iloc[start:start + block_size] for chunk in chunks \
+        for start in range(0, chunk.shape[0], block_size))
+    rows = 0
+    if jobs <= 1:
+        for block in blocks:
+            fp.write(format_star_rows(block, fmt))
+            rows += block.shape[0]
+        return rows
+    with ProcessPoolExecutor(max_workers = jobs) as pool:
+        pending = deque()
+        for block in blocks:
+            pending.append(pool.submit(format_star_rows, block, fmt))
+            rows += block.shape[0]
+            if len(pending) >= 2 * jobs:
+                fp.write(pending.popleft().result())
+        while pending:
+            fp.write(pending.popleft().result())
+    return rows
+
+def read_star_block(filename, name):
+    """
+        DataFrame of the loop data_name of any star file, e.g. data_model_classes of a model star file or
+        data_micrographs of a micrograph star file. Only the bytes of that block are read.
+    """
+    index = get_star_index(filename)
+    block = index.get_block(name)
+    if block is None or not block["loop"]:
+        print_error("{} has no data_{} loop".format(filename, name))
+    end = index.get_end(block)
+    with index.open() as f:
+        f.seek(block["data_offset"])
+        if end == index.get_size():
+            text = f
+        else:
+            text = io.BytesIO(f.read(end - block["data_offset"]))
+        return pd.read_csv(text, sep = r'\s+', engine = "c", names = block["columns"], comment = "#", \
+            dtype = get_label_dtypes(block["columns"]), na_filter = False, skip_blank_lines = True)
+
+def get_close_pairs(x, y, groups, distance):
+    """
+        All the pairs (i, j) of points of the same group closer than distance, through a grid of cells of
+        size distance: only the points of the same and of the 8 neighbouring cells are compared, so the
+        cost grows with the number of close pairs rather than with the square of the group sizes.
+    """
+    n = len(x)
+    if n == 0:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+    cx = np.floor((x - x.min()) / distance).astype(np.int64) + 1
+    cy = np.floor((y - y.min()) / distance).astype(np.int64) + 1
+    ny, nx = int(cy.max()) + 2, int(cx.max()) + 2
+    if (int(groups.max()) + 1) * nx * ny >= 2 ** 62:
+        print_error("The coordinates span too many cells of {} pixels".format(distance))
+    cell = (groups.astype(np.int64) * nx + cx) * ny + cy
+    order = np.argsort(cell, kind = "stable")
+    sorted_cell = cell[order]
+    first, second = [], []
+    # Every pair of neighbouring cells once: the cell itself and 4 of its 8 neighbours
+    for dx, dy in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+        target = cell + dx * ny + dy
+        start = np.searchsorted(sorted_cell, target, side = "left")
+        counts = np.searchsorted(sorted_cell, target, side = "right") - start
+        i = np.repeat(np.arange(n), counts)
+        j = order[np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(start, counts)]
+        if dx == 0 and dy == 0:
+            i, j = i[i < j], j[i < j]
+        close = (x[i] - x[j]) ** 2 + (y[i] - y[j]) ** 2 < distance ** 2
+        first.append(i[close])
+        second.append(j[close])
+    return np.concatenate(first), np.concatenate(second)
+
+def find_duplicates(x, y, groups, rank, distance):
+    """
+        Mask of the points to drop as duplicates: going from the best rank (lowest) to the worst, a point
+        is kept unless it is closer than distance to a point of the same group kept before.
+        The greedy pass is done in rounds, every round keeps the points ranked better than all of their
+        undecided neighbours and drops the neighbours of the kept points, which gives the same result.
+    """
+    a, b = get_close_pairs(x, y, groups, distance)
+    # 0 undecided, 1 kept, 2 dropped
+    state = np.ones(len(x), np.int8)
+    state[a] = 0
+    state[b] = 0
+    worst = np.iinfo(np.int64).max
+    while (state == 0).any():
+        live = (state[a] == 0) & (state[b] == 0)
+        best = np.full(len(x), worst, np.int64)
+        np.minimum.at(best, a[live], rank[b[live]])
+        np.minimum.at(best, b[live], rank[a[live]])
+        state[(state == 0) & (rank < best)] = 1
+        state[b[(state[a] == 1) & (state[b] == 0)]] = 2
+        state[a[(state[b] == 1) & (state[a] == 0)]] = 2
+    return state == 2
 
 class STAR():
     """
@@ -32,73 +237,190 @@ class STAR():
 
     """
 
-    def __init__(self, filename, idx = "rlnImageName", wipe_zero = True, inplace = False):
+    _header_fields = ("_version", "_optics_header", "_optics", "_particles_header",
+                      "_particles_columns", "_particle_start_nr", "_particles_end")
+    # Byte offset where the particles loop ends when another block follows it, see read_star_header
+    _particles_end = None
+
+    def __init__(self, filename, idx = "rlnImageName", wipe_zero = True, inplace = False, chunksize = None,
+                 cache_dir = None, cache_size = 0, columns = None, optics_after = False):
+        """
+            With columns set, only these columns (and the idx column) are parsed, the other columns are
+            parsed when they are needed for the first time, e.g. by to_star. idx can be None if the
+            particle names are not needed at all.
+            With chunksize set, the particles loop is not loaded into memory. The content is then
+            read on demand as DataFrames of at most chunksize rows through iter_chunks().
+            With cache_dir set, the parsed star file is kept there as a binary sidecar and later loads
+            of the unchanged file are read from it. cache_size (bytes) bounds the cache directory.
+            With optics_after set, a data_optics block after the particles loop is looked for too.
+        """
 
         assert ( ".star" in filename ), "Your input {} has no .star suffix...".format(filename)
-        self._get_header(filename)
-        self._get_ctf()
+        self._filename = filename
+        self._idx = idx
+        self._chunksize = chunksize
+        self._cache_dir = cache_dir
+        self._optics_after = optics_after
+        self._columns = None if columns is None else [c for c in columns if c != idx]
+        self._content = None
+        # Column codes of the DataFrame, shared with the copies of this star file
+        self._lookups = {}
+
+        if cache_dir and not chunksize:
+            with stage("cache read"):
+                cached = load_sidecar(filename, cache_dir, columns = self._get_usecols())
+            if cached and cached[1].index.name == idx:
+                for k, v in cached[0].items():
+                    setattr(self, k, v)
+                self._get_ctf()
+                self._content = cached[1]
+                return
+
+        with stage("header"):
+            self._get_header(filename)
+            self._get_ctf()
 
+        if not self.is_streaming():
+            with stage("read") as st:
+                self._content = self._read_particles()
+                st["rows"] = self._content.shape[0]
+            if cache_dir and self._columns is None:
+                header = {k: getattr(self, k) for k in self._header_fields}
+                with stage("cache write"):
+                    save_sidecar(filename, cache_dir, header, self._content, max_size = cache_size)
+
+    def _get_usecols(self, columns = None):
+        """Columns to parse, None means the whole particles loop"""
+        if columns is None:
+            columns = self._columns
+        if columns is None:
+            return None
+        return ([self._idx] if self._idx else []) + list(columns)
+
+    def _read_particles(self, chunksize = None, columns = None, source = None):
+        """
+            Parse the particles loop with the C tokenizer of pandas. Whitespace is the only delimiter
+            in a star file and there are no missing values, so the NA detection is switched off and
+            the well known labels are given their dtype instead of being guessed. Comment lines, e.g. the
+            "# version" line before a block after the particles loop, are skipped.
+            A .gz/.zst star file is decompressed by a background thread while it is parsed, source is
+            then the open stream, see _open_particles. It must be given to read chunks.
+        """
+        usecols = self._get_usecols(columns)
+        for col in (usecols or [self._idx]):
+            if col and col not in self._particles_columns:
+                print_error("{} Column not found from star file".format(col))
+        if source is None:
+            source = self._open_particles()
+            if source is not None:
+                with source:
+                    return self._read_particles(columns = columns, source = source)
+        with self._parsing():
+            return pd.read_csv(source or self._filename, sep = r'\s+', engine = "c", skiprows = self._particle_start_nr,\
+                 names = self._particles_columns, usecols = usecols, \
+                 dtype = get_label_dtypes(usecols or self._particles_columns), na_filter = False, \
+                 comment = "#", skip_blank_lines = True, index_col = self._idx, chunksize = chunksize)
+
+    def _open_particles(self):
+        """
+            Stream to parse the particles loop from for a .gz/.zst star file, or for a star file with another
+            block after the particles loop, which the stream stops short of. None to parse the file itself.
+        """
+        if get_compression(self._filename) or self._particles_end is not None:
+            return open_star_file(self._filename, size = self._particles_end)
+        return None
+
+    @contextmanager
+    def _parsing(self):
+        """Exit with print_error on the errors of pandas and of the decompression"""
         try:
-            self._content = pd.read_csv(filename, sep = '\s+', skiprows = self._particle_start_nr,\
-                 names = self._particles_columns, skipinitialspace = True, skip_blank_lines = True, index_col = idx) 
+            yield
         except ValueError:
-            print_error("rlnImageName Column not found from star file")
+            print_error("Failed to parse the particles loop of {}".format(self._filename))
         except FileNotFoundError:
             print_error("Specified File doesn't exist")
+        except (EOFError, OSError):
+            print_error("Failed to decompress {}".format(self._filename))
 
-    def _get_header(self, filename):
+    def iter_chunks(self, chunksize = None, columns = None):
+        """
+            Yield the particles loop as DataFrames of at most chunksize rows.
+            In streaming mode, columns narrows down the columns to parse.
+        """
+        if not self.is_streaming():
+            yield self._content
+            return
+        source = self._open_particles()
+        try:
+            reader = self._read_particles(chunksize = chunksize or self._chunksize, columns = columns, source = source)
+            with reader:
+                while True:
+                    # The chunks are parsed on demand, their errors come up here and not in _read_particles
+                    with self._parsing():
+                        chunk = next(reader, None)
+                    if chunk is None:
+                        break
+                    yield chunk
+        finally:
+            if source is not None:
+                source.close()
 
-        self._version = "3.0"
-        self._optics_header = ""
-        self._optics = []
-        self._particles_header = ""
-        self._particles_columns = []
-        flag_30 = False
-        flag_31_opt = False
-        flag_31_pctl = False
-        blnk = re.compile(r"^\s*$")
-
-        with open(filename) as f:
-            for nr, ln in enumerate(f.readlines(1000)):
-                if ln.startswith("data_"):
-                    if "optics" in ln:
-                        self._version = "3.1"
-                        self._optics_header = "data_optics\nloop_\n"
-                        self._particles_header = "data_particles\nloop_\n"
-                        flag_31_opt = True
-                    elif "particles" in ln:
-                        flag_31_pctl = True
-                    else:
-                        self._version = "3.0"
-                        self._particles_header = "data_\nloop_\n"
-                        flag_30 = True
-                    continue
-
-                elif ln.startswith("loop_") or ln.startswith("#") or re.match(blnk, ln):
-                    continue
+    def load_columns(self, columns):
+        """Parse the columns which were left out when the star file was opened with columns"""
+        if self._content is None or self._columns is None:
+            return self
+        missing = [c for c in columns if c in self._particles_columns and c != self._idx \
+            and c not in self._content.columns]
+        if missing:
+            cached = load_sidecar(self._filename, self._cache_dir, columns = missing) if self._cache_dir else None
+            df = cached[1] if cached else self._read_particles(columns = missing)
+            pos = self._get_file_rows(df.index)
+            self._content = self._content.assign(**{c: df[c].array.take(pos) for c in missing})
+            self._columns += missing
+        if set(self._particles_columns) - set(self._columns) <= {self._idx}:
+            self._columns = None
+        return self
 
-                else:
-                    if flag_31_pctl or flag_30:
-                        if ln.startswith("_rln"):
-                            self._particles_columns.append(ln.split(" ")[0][1:])
-                            self._particle_start_nr = nr + 1
-                    else:
-                        self._optics.append(ln)
+    def _get_file_rows(self, names):
+        """
+            Positions in the particles loop, whose names in file order are given, of the rows of the DataFrame.
+            A name repeated in the star file (e.g. after symmetry expansion) stands for its rows in file order.
+        """
+        index = self._content.index
+        if len(index) == len(names) and index.equals(names):
+            return np.arange(len(names))
+        if names.is_unique:
+            return names.get_indexer(index)
+        # Rows were removed, the k-th row of a name is its k-th row in the file if none of its rows were
+        counts = pd.Series(names).value_counts()
+        kept = pd.Series(index).value_counts()
+        if (counts[kept.index].to_numpy() != kept.to_numpy()).any():
+            print_error("Some rows of repeated particles were removed before all the columns were loaded")
+        def occurrences(labels):
+            return pd.MultiIndex.from_arrays([labels, pd.Series(labels).groupby(labels).cumcount().to_numpy()])
+        return occurrences(names).get_indexer(occurrences(index))
+
+    def load_all_columns(self):
+        if self._content is None or self._columns is None:
+            return self
+        self.load_columns(self._particles_columns)
+        order = [c for c in self._particles_columns if c in self._content.columns]
+        self._content = self._content[order + [c for c in self._content.columns if c not in order]]
+        return self
 
+    def _get_header(self, filename):
+        for k, v in read_star_header(filename, optics_after = self._optics_after).items():
+            setattr(self, "_" + k, v)
         print_info("The star file is from RELION {}".format("3.0 or older" if self._version == "3.0" else "3.1 or newer"))
     
     def _get_ctf(self):
         if self._version == "3.1":
-            cols, vals = [], []
-            self._ctf = {}
-            for ele in self._optics:
-                if ele.startswith("_rln"):
-                    cols.append(ele.split(" ")[0][1:])
-                else:
-                    vals = re.split(r"\s+", ele)
-            for i,j in enumerate(cols):
-                self._ctf[j] = vals[i]
+            # The last optics group stands for the dataset, as it always did, get_optics_values looks up the others
+            self._optics_groups = get_optics_groups(self._optics)
+            self._ctf = self._optics_groups[-1]
             print_dict(self._ctf)
+            if len(self._optics_groups) > 1:
+                print_info("The star file has {} optics groups".format(len(self._optics_groups)))
             self._mics_apix = float(self._ctf["rlnMicrographOriginalPixelSize"])
             self._image_apix = float(self._ctf["rlnImagePixelSize"])
             self._downscale_factor = self._image_apix // self._mics_apix
@@ -109,65 +431,250 @@ class STAR():
             self._amp = float(self._ctf["rlnAmplitudeContrast"])
         else:
             pass
+    def get_optics_values(self, label, groups = None):
+        """
+            Value of label in the optics table as float, for every optics group number in groups (an array),
+            or of the last optics group if groups is None
+        """
+        if groups is None:
+            return float(self._ctf[label])
+        table = {int(g["rlnOpticsGroup"]): float(g[label]) for g in self._optics_groups}
+        lookup = np.full(max(table) + 1, np.nan)
+        for nr, value in table.items():
+            lookup[nr] = value
+        groups = np.asarray(groups, dtype = np.int64)
+        if len(groups) and (groups.min() < 0 or groups.max() >= len(lookup) or np.isnan(lookup[groups]).any()):
+            print_error("Some optics groups of the particles are missing from the optics table")
+        return lookup[groups]
+
     #Query basic information of this DataFrame
+    def is_streaming(self):
+        return bool(self._chunksize) and self._content is None
     def has_required_columns(self, columns):
+        if self.is_streaming() or self._columns is not None:
+            return set(columns).issubset(self._particles_columns)
         return set(columns).issubset(self._content.columns)
     def has_unique_particles_path(self):
         pass
     def get_star_version(self):
         return self._version
     def get_index(self):
-        return self._content.index.tolist()
+        index = []
+        for chunk in self.iter_chunks():
+            index.extend(chunk.index.tolist())
+        return index
     def get_header_content(self):
         """return the first line until the column name line"""
         return self._particles_columns
     def get_column_content(self, col_name, uniq = True):
+        self.load_columns([col_name])
         if uniq:
-            return list(set(self._content[col_name].tolist()))
+            values = set()
+            for chunk in self.iter_chunks():
+                values.update(chunk[col_name].tolist())
+            return list(values)
         else:
-            return self._content[col_name].tolist()
+            values = []
+            for chunk in self.iter_chunks():
+                values.extend(chunk[col_name].tolist())
+            return values
     def get_particle_names(self):
         return self._content.index.tolist()
     def get_particles_path(self):
-        return os.path.split(self.get_particle_names()[0].split("@")[1])[0]
+        first = next(self.iter_chunks(chunksize = 1)).index[0]
+        return os.path.split(first.split("@")[1])[0]
     def get_particle_nr(self):
         return self._content.shape[0]
+    def get_memory_usage(self):
+        """Bytes taken by the DataFrame, the strings included"""
+        return int(self._content.memory_usage(index = True, deep = True).sum())
     def get_defocus_range(self):
-        return self._content['rlnDefocusU'].min, self._content['rlnDefocusU'].max, self._content['rlnDefocusU'].median
+        self.load_columns(['rlnDefocusU'])
+        return self._content['rlnDefocusU'].min(), self._content['rlnDefocusU'].max(), self._content['rlnDefocusU'].median()
     def get_micrograph_number(self):
+        self.load_columns(['rlnMicrographName'])
         return len(set(self._content['rlnMicrographName']))
     def get_image_apix(self):
         if self._version == "3.0":
-            return self._content.iloc[1,'rlnPixelSize'] / self._content.iloc[1,'rlnMaginification']
+            self.load_columns(['rlnDetectorPixelSize', 'rlnMagnification'])
+            row = self._content.iloc[0]
+            return row['rlnDetectorPixelSize'] * 10000 / row['rlnMagnification']
         else:
             return self._image_apix
 
+    def collect_info(self, sample_size = 100000):
+        """
+            Gather the statistics of the info mode in one pass over the particles loop, which also works
+            in streaming mode with constant memory. The defocus median is taken from a uniform random
+            sample of sample_size particles, so it is exact for smaller star files.
+        """
+        wanted = ['rlnMicrographName', 'rlnDefocusU', 'rlnClassNumber', 'rlnOpticsGroup']
+        if self._version == "3.0":
+            wanted += ['rlnDetectorPixelSize', 'rlnMagnification']
+        columns = [c for c in wanted if c in self._particles_columns]
+        rng = np.random.RandomState(0)
+        particle_nr = 0
+        micrographs = set()
+        defocus_min, defocus_max = np.inf, -np.inf
+        sample, priority = np.empty(0), np.empty(0)
+        classes, optics_groups = Counter(), Counter()
+        apix = None if self._version == "3.0" else self._image_apix
+
+        for chunk in self.iter_chunks(columns = columns):
+            particle_nr += chunk.shape[0]
+            if 'rlnMicrographName' in chunk:
+                micrographs.update(pd.unique(chunk['rlnMicrographName']))
+            if 'rlnDefocusU' in chunk and chunk.shape[0]:
+                defocus = chunk['rlnDefocusU'].to_numpy(dtype = float)
+                defocus_min = min(defocus_min, defocus.min())
+                defocus_max = max(defocus_max, defocus.max())
+                # Keep the sample_size values with the smallest random priorities, a uniform sample
+                sample = np.concatenate([sample, defocus])
+                priority = np.concatenate([priority, rng.random_sample(defocus.shape[0])])
+                if sample.shape[0] > sample_size:
+                    keep = np.argpartition(priority, sample_size)[:sample_size]
+                    sample, priority = sample[keep], priority[keep]
+            if 'rlnClassNumber' in chunk:
+                classes.update(chunk['rlnClassNumber'].value_counts().to_dict())
+            if 'rlnOpticsGroup' in chunk:
+                optics_groups.update(chunk['rlnOpticsGroup'].value_counts().to_dict())
+            if apix is None and 'rlnMagnification' in chunk and chunk.shape[0]:
+                row = chunk.iloc[0]
+                apix = float(row['rlnDetectorPixelSize'] * 10000 / row['rlnMagnification'])
+
+        info = {"file": self._filename, "version": self._version, "particles": particle_nr,
+                "micrographs": len(micrographs), "pixel_size": apix}
+        if sample.shape[0]:
+            info["defocus"] = {"min": float(defocus_min), "max": float(defocus_max), "median": float(np.median(sample)),
+                               "median_exact": particle_nr <= sample_size}
+        if classes:
+            info["classes"] = {str(k): int(v) for k, v in sorted(classes.items())}
+        if optics_groups:
+            info["optics_groups"] = {str(k): int(v) for k, v in sorted(optics_groups.items())}
+        return info
+
+    def copy(self):
+        """
+            A copy of the star file which can be filtered and recentered on its own. The DataFrame is not
+            copied: keep_rows, drop_rows, human_recenter, load_columns and assign_optics_groups give the
+            copy a new DataFrame instead of changing the shared one. The column codes built on the shared
+            DataFrame are shared as well.
+        """
+        new = copy.copy(self)
+        new._columns = None if self._columns is None else list(self._columns)
+        return new
+
     #Filter data from the STAR DataFrame.
     #The following function made change to the dataframe, so 'inplace' option is supported.
     def update_content(self,df):
         self._content = df
 
-    def keep_rows(self, idx_list, inplace = False):
-        if set(idx_list).issubset(self._content.index):
+    def get_row_positions(self, idx_list):
+        """
+            Positions in the DataFrame of the particles named in idx_list, every row of a name repeated in
+            the star file (e.g. after symmetry expansion) in the order of idx_list, like .loc does. Exits if
+            some of them are missing. pandas keeps the hash table of the index, so the next lookups on the
+            same DataFrame, e.g. in batch mode or by the server, only hash idx_list.
+        """
+        pos = self._content.index.get_indexer_for(idx_list)
+        if (pos >= 0).all():
             print_info("Original dataset contains all the items in subset")
         else:
             print_error("Original dataset doesn't cover all the items in subset")
+        return pos
+
+    def get_column_codes(self, col_name):
+        """(codes, uniques) of pd.factorize on a column, kept until the DataFrame changes"""
+        self.load_columns([col_name])
+        cached = self._lookups.get("codes")
+        if cached is None or cached[0] is not self._content:
+            cached = self._lookups["codes"] = (self._content, {})
+        if col_name not in cached[1]:
+            cached[1][col_name] = pd.factorize(self._content[col_name])
+        return cached[1][col_name]
+
+    def get_rows(self, positions):
+        """The particles at positions of the DataFrame"""
+        return self._content.iloc[positions]
+
+    def keep_rows(self, idx_list, inplace = False):
+        if self.is_streaming():
+            return self._keep_rows_chunks(idx_list)
+        with stage("keep_rows") as st:
+            df = self._content.iloc[self.get_row_positions(idx_list)]
+            st["rows"] = self._content.shape[0]
         if inplace:
-            self._content = self._content.loc[idx_list]
+            self._content = df
             return self
         else:
-            return self._content.loc[idx_list]
+            return df
+
+    def _keep_rows_chunks(self, idx_list):
+        """Streaming counterpart of keep_rows, the rows come out in the order of the star file"""
+        # Every chunk is looked up in the hash table of the distinct subset names, built once
+        wanted = pd.Index(idx_list).unique()
+        found = np.zeros(len(wanted), bool)
+        for chunk in self.iter_chunks():
+            pos = wanted.get_indexer(chunk.index)
+            keep = pos >= 0
+            found[pos[keep]] = True
+            yield chunk[keep]
+        if not found.all():
+            print_error("Original dataset doesn't cover all the items in subset")
+        print_info("Original dataset contains all the items in subset")
 
     def drop_rows(self, col_name, exclude_list, inplace = False):
+        if self.is_streaming():
+            return self._drop_rows_chunks(col_name, exclude_list)
+        with stage("drop_rows") as st:
+            # Look up the distinct values only, then broadcast the result through the integer codes
+            codes, uniques = self.get_column_codes(col_name)
+            mask = uniques.isin(exclude_list)[codes]
+            st["rows"] = len(mask)
         if inplace:
-            mask = self._content[col_name].isin(exclude_list)
-            df = self._content[~mask]
-            return df
+            self._content = self._content[~mask]
+            return self
         else:
-            mask = self._content[col_name].isin(exclude_list)
             df = self._content[~mask]
             return df
 
+    def remove_duplicates(self, distance, score = None, col_name = 'rlnMicrographName', jobs = 1, inplace = False):
+        """
+            Drop the particles closer than distance (pixels of rlnCoordinateX/Y) to a better particle of the
+            same micrograph, e.g. the particles moved onto the same spot by human_recenter. The best particle
+            has the highest value of the score column, or comes first in the star file without a score.
+            With jobs > 1 the micrographs are split between a pool of processes.
+        """
+        self.load_columns(['rlnCoordinateX', 'rlnCoordinateY'] + ([score] if score else []))
+        if score and score not in self._content.columns:
+            print_error("Column {} to keep the best particles is not in the star file".format(score))
+        with stage("remove_duplicates") as st:
+            codes = self.get_column_codes(col_name)[0]
+            x = self._content['rlnCoordinateX'].to_numpy(dtype = float)
+            y = self._content['rlnCoordinateY'].to_numpy(dtype = float)
+            n = self._content.shape[0]
+            rank = np.empty(n, np.int64)
+            if score:
+                rank[np.argsort(-self._content[score].to_numpy(dtype = float), kind = "stable")] = np.arange(n)
+            else:
+                rank[:] = np.arange(n)
+            if jobs <= 1:
+                drop = find_duplicates(x, y, codes, rank, distance)
+            else:
+                drop = np.zeros(n, bool)
+                parts = [np.flatnonzero(codes % jobs == k) for k in range(jobs)]
+                with ProcessPoolExecutor(max_workers = jobs) as pool:
+                    results = pool.map(find_duplicates, *zip(*[(x[p], y[p], codes[p], rank[p], distance) for p in parts]))
+                    for p, part_drop in zip(parts, results):
+                        drop[p] = part_drop
+            st["rows"] = n
+        print_info("{} duplicated particles within {} pixels are removed, {} are left".format(drop.sum(), distance, n - drop.sum()))
+        if inplace:
+            self._content = self._content[~drop]
+            return self
+        else:
+            return self._content[~drop]
+
     def filter_exclude_rows(self, filters = "", threshold = 0, inplace = False ):
         pass
 
@@ -175,6 +682,7 @@ class STAR():
         pass
 
     def keep_columns(self, column_list, inplace = False):
+        self.load_columns(column_list)
         if inplace:
             self._content = self._content[column_list]
             return self
@@ -207,34 +715,92 @@ class STAR():
             else:
                 return new
 
-    #Speficialized function for STAR Modification
-    def human_recenter(self, minx, miny, maxx, maxy, d, inplace = True):
-        df = self._content[self._content.rlnClassNumber.isin([int(key) for key in d.keys()])]
-        if self.get_star_version() == "3.0":
-            downscale_factor = int(input("Please provide the downscale factor of parcticle stacks:\n"))
-            for idx, row in df.iterrows():
-                cls_number = str(row['rlnClassNumber'])
-                offsets = get_offset_xy(row['rlnAnglePsi'], d[cls_number][0] * downscale_factor, d[cls_number][1] * downscale_factor)
-                row['rlnCoordinateX'] -= row["rlnOriginX"] + offsets[0]
-                row['rlnCoordinateX'] = min(maxx, max(minx, row['rlnCoordinateX']))
-                df.loc[idx,"rlnCoordinateX"] = row["rlnCoordinateX"]
-                row['rlnCoordinateY'] -= row["rlnOriginY"] + offsets[1]
-                row['rlnCoordinateY'] = min(maxy, max(miny, row['rlnCoordinateY']))
-                df.loc[idx,"rlnCoordinateY"] = row["rlnCoordinateY"]
-            df["rlnOriginX"].values[:] = 0
-            df["rlnOriginY"].values[:] = 0
+    def assign_optics_groups(self, groups, on = "rlnMicrographName"):
+        """
+            Split the optics groups by groups, a dict or Series from the values of the on column (normally
+            the micrograph names) to a group label, e.g. the beam shift classes of BeamGroup.py.
+            Every (old optics group, group) pair in use becomes a new optics group, its row in the optics
+            table is cloned from the old one and renumbered. The particles are looked up through the
+            integer codes of the distinct on values, so only those are matched against groups.
+        """
+        if self._version == "3.0":
+            print_error("Optics groups can only be written into a RELION 3.1 star file")
+        if self.is_streaming():
+            print_error("Optics groups can't be assigned in streaming mode, please drop --chunksize")
+        self.load_columns([on, "rlnOpticsGroup"])
+        values = self._content.index if on == self._idx else self._content[on]
+        codes, uniques = pd.factorize(values)
+        groups = pd.Series(groups)
+        table = groups[~groups.index.duplicated()].reindex(uniques)
+        missing = int(table.isna().sum())
+        if missing:
+            print_error("{} of the {} {} have no group assigned".format(missing, len(uniques), on))
+        group_codes, group_labels = pd.factorize(table, sort = True)
+        group = group_codes[codes].astype(np.int64)
+
+        if "rlnOpticsGroup" in self._content.columns:
+            old = self._content["rlnOpticsGroup"].to_numpy(dtype = np.int64)
         else:
-            for idx, row in df.iterrows():
-                clsnr = str(row['rlnClassNumber'])
-                offsets = get_offset_xy(row['rlnAnglePsi'], d[clsnr][0] * self._downscale_factor, d[clsnr][1] * self._downscale_factor)
-                row['rlnCoordinateX'] -= row["rlnOriginXAngst"] / self._image_apix + offsets[0]
-                row['rlnCoordinateX'] = min(maxx, max(minx, row['rlnCoordinateX']))
-                df.loc[idx,"rlnCoordinateX"] = row["rlnCoordinateX"]
-                row['rlnCoordinateY'] -= row["rlnOriginYAngst"] / self._image_apix + offsets[1]
-                row['rlnCoordinateY'] = min(maxy, max(miny, row['rlnCoordinateY']))
-                df.loc[idx,"rlnCoordinateY"] = row["rlnCoordinateY"]
-            df["rlnOriginXAngst"].values[:] = 0
-            df["rlnOriginYAngst"].values[:] = 0
+            old = np.ones(len(group), dtype = np.int64)
+        pairs, new = np.unique(old * len(group_labels) + group, return_inverse = True)
+
+        labels, rows = get_optics_table(self._optics)
+        if "rlnOpticsGroup" not in labels:
+            print_error("The optics table has no rlnOpticsGroup column")
+        group_col = labels.index("rlnOpticsGroup")
+        old_rows = {int(row[group_col]): row for row in rows}
+        new_rows = []
+        for nr, pair in enumerate(pairs, 1):
+            if pair // len(group_labels) not in old_rows:
+                print_error("Optics group {} is not in the optics table".format(pair // len(group_labels)))
+            row = list(old_rows[pair // len(group_labels)])
+            row[group_col] = str(nr)
+            if "rlnOpticsGroupName" in labels:
+                row[labels.index("rlnOpticsGroupName")] = "opticsGroup{}".format(nr)
+            new_rows.append(row)
+        self._optics = ["_{} #{} \n".format(l, i + 1) for i, l in enumerate(labels)]
+        self._optics += ["  ".join(row) + " \n" for row in new_rows]
+        # A new DataFrame, the old one may be shared with copies of this star file
+        self._content = self._content.assign(rlnOpticsGroup = (new + 1).astype(np.int64))
+        self._get_ctf()
+        print_info("{} optics groups are assigned".format(len(new_rows)))
+        return self
+
+    #Speficialized function for STAR Modification
+    def human_recenter(self, minx, miny, maxx, maxy, d, inplace = True, downscale = None):
+        """
+            Move the particles of the classes in d by the (dx, dy) clicked on their class average. The class
+            averages of a RELION 3.0 star file are downscaled by downscale, asked for if it isn't given.
+        """
+        self.load_columns(['rlnClassNumber', 'rlnAnglePsi', 'rlnCoordinateX', 'rlnCoordinateY',
+                           'rlnOriginX', 'rlnOriginY', 'rlnOriginXAngst', 'rlnOriginYAngst', 'rlnOpticsGroup'])
+        with stage("recenter") as st:
+            df = self._content[self._content.rlnClassNumber.isin([int(key) for key in d.keys()])].copy()
+            if self.get_star_version() == "3.0":
+                downscale_factor = downscale or int(input("Please provide the downscale factor of parcticle stacks:\n"))
+                origin_x = df["rlnOriginX"].to_numpy(dtype = float)
+                origin_y = df["rlnOriginY"].to_numpy(dtype = float)
+                origin_cols = ["rlnOriginX", "rlnOriginY"]
+            else:
+                # Every optics group has its own pixel sizes
+                groups = df["rlnOpticsGroup"].to_numpy() if "rlnOpticsGroup" in df.columns else None
+                image_apix = self.get_optics_values("rlnImagePixelSize", groups)
+                downscale_factor = image_apix // self.get_optics_values("rlnMicrographOriginalPixelSize", groups)
+                origin_x = df["rlnOriginXAngst"].to_numpy(dtype = float) / image_apix
+                origin_y = df["rlnOriginYAngst"].to_numpy(dtype = float) / image_apix
+                origin_cols = ["rlnOriginXAngst", "rlnOriginYAngst"]
+
+            # Lookup table from class number to the clicked (dx, dy) of its class average
+            shift = np.zeros((max(int(key) for key in d.keys()) + 1, 2)) if d else np.zeros((1, 2))
+            for cls, xy in d.items():
+                shift[int(cls)] = xy
+            shift = shift[df["rlnClassNumber"].to_numpy()] * np.reshape(downscale_factor, (-1, 1))
+            offset_x, offset_y = get_offset_xy(df["rlnAnglePsi"].to_numpy(dtype = float), shift[:, 0], shift[:, 1])
+
+            df["rlnCoordinateX"] = np.clip(df["rlnCoordinateX"].to_numpy(dtype = float) - (origin_x + offset_x), minx, maxx)
+            df["rlnCoordinateY"] = np.clip(df["rlnCoordinateY"].to_numpy(dtype = float) - (origin_y + offset_y), miny, maxy)
+            df[origin_cols] = 0.0
+            st["rows"] = df.shape[0]
 
         if inplace:
             print_info("Updating")
@@ -242,22 +808,47 @@ class STAR():
         else:
             return df
 
-    def to_star(self, output_file_name):
-        """
-            This function writes STAR instance into star file
-            Relion 3.1 star file = optics_header + optics + particle_header + particles_column + content
-            Relion 3.0 star file = particle_header + particles_column + content
-        """
+    def _drop_rows_chunks(self, col_name, exclude_list):
+        """Streaming counterpart of drop_rows"""
+        exclude_list = set(exclude_list)
+        for chunk in self.iter_chunks():
+            yield chunk[~chunk[col_name].isin(exclude_list)]
+
+    def _star_header(self, columns):
         if self._version == "3.0":
             h = self._particles_header + "_rlnImageName #1\n"
-            for i,j in enumerate(self._content.columns.tolist()):
-                h += "_{} #{}\n".format(j,str(i+2))
         else:
             h = self._optics_header + "".join(self._optics)
             h += "\n" + self._particles_header + "_rlnImageName #1\n"
-            for i,j in enumerate(self._content.columns.tolist()):
-                h += "_{} #{}\n".format(j,str(i+2))
-        with open(output_file_name, 'w') as star:
-            star.write(h)
-            self._content.to_csv(path_or_buf = star, sep = " ", header = False, float_format = "%6f")
-        print_info("Saved to file: {}".format(output_file_name))
\ No newline at end of file
+        for i,j in enumerate(columns):
+            h += "_{} #{}\n".format(j,str(i+2))
+        return h
+
+    def to_star(self, output_file_name, chunks = None, jobs = 1):
+        """
+            This function writes STAR instance into star file
+            Relion 3.1 star file = optics_header + optics + particle_header + particles_column + content
+            Relion 3.0 star file = particle_header + particles_column + content
+            The content can be given as an iterable of DataFrame chunks (e.g. from keep_rows/drop_rows
+            in streaming mode), which are written one after another.
+            With jobs > 1 the rows are formatted by a pool of processes and written in order.
+            An output name ending with .gz or .zst is compressed, by jobs threads.
+        """
+        if chunks is None:
+            self.load_all_columns()
+            chunks = self.iter_chunks()
+        chunks = iter(chunks)
+        with open_star_file(output_file_name, "w", jobs = jobs) as star, stage("write") as st:
+            try:
+                first = next(chunks, None)
+                if first is None:
+                    star.write(self._star_header([c for c in self._particles_columns if c != self._idx]))
+                else:
+                    star.write(self._star_header(first.columns.tolist()))
+                    st["rows"] = write_star_rows(star, itertools.chain([first], chunks), get_column_formats(first), jobs)
+            except SystemExit:
+                # A streamed filter gave up half way, don't leave a truncated star file behind
+                star.close()
+                os.remove(output_file_name)
+                raise
+        print_info("Saved to file: {}".format(output_file_name))
@@ -0,0 +1,133 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#           Stage timings and memory usage of a rockstar run               #
+############################################################################
+import atexit
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from MyTools import *
+
+# Profiling is off unless enable_profiling is called, stage() then hands out this shared no-op context
+_profiler = None
+_null_stage = nullcontext({})
+
+def get_memory_mb(field = "VmRSS"):
+    """Resident (VmRSS) or peak resident (VmHWM) memory of this process in MB, 0 where /proc is missing"""
+    try:
+        with open("/proc/self/status") as fp:
+            for ln in fp:
+                if ln.startswith(field + ":"):
+                    return int(ln.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return 0.0
+
+def stage(name):
+    """
+        Context manager timing the stage name when profiling is on. It yields a dictionary, setting its
+        "rows" reports the rows per second of the stage.
+    """
+    if _profiler is None:
+        return _null_stage
+    return _profiler.stage(name)
+
+def enable_profiling(trace_file = None, memory = False, cprofile_file = None):
+    """Turn on the stage timings, the report is printed and saved when the program exits"""
+    global _profiler
+    if _profiler is None:
+        _profiler = StageProfiler(trace_file, memory = memory, cprofile_file = cprofile_file)
+        atexit.register(_profiler.finish)
+    return _profiler
+
+class StageProfiler():
+    """
+        Wall time, resident memory and optionally the python allocations (tracemalloc) of the stages of
+        a run. The resident memory is sampled by a background thread every interval seconds, so the peak
+        of every stage is known and not only the memory at its end. Stages can be nested.
+    """
+    def __init__(self, trace_file = None, memory = False, cprofile_file = None, interval = 0.01):
+        self._trace_file = trace_file
+        self._memory = memory
+        self._cprofile_file = cprofile_file
+        self._records = []
+        self._depth = 0
+        self._peak = get_memory_mb()
+        self._traced_peak = 0
+        self._t0 = time.perf_counter()
+        self._done = threading.Event()
+        self._sampler = threading.Thread(target = self._sample, args = (interval,), daemon = True)
+        self._sampler.start()
+        if memory:
+            tracemalloc.start()
+        self._cprofile = None
+        if cprofile_file:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def _sample(self, interval):
+        while not self._done.wait(interval):
+            self._peak = max(self._peak, get_memory_mb())
+
+    @contextmanager
+    def stage(self, name):
+        record = {"name": name, "depth": self._depth}
+        outer_peak = self._peak
+        self._peak = get_memory_mb()
+        if self._memory:
+            traced_start, traced_peak = tracemalloc.get_traced_memory()
+            outer_traced = max(self._traced_peak, traced_peak)
+            self._traced_peak = 0
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            self._depth -= 1
+            rss = get_memory_mb()
+            record.update({"start": start - self._t0, "seconds": seconds, "rss_mb": rss,
+                           "peak_rss_mb": max(self._peak, rss)})
+            self._peak = max(outer_peak, record["peak_rss_mb"])
+            if record.get("rows") is not None and seconds > 0:
+                record["rows_per_second"] = record["rows"] / seconds
+            if self._memory:
+                traced_peak = max(self._traced_peak, tracemalloc.get_traced_memory()[1])
+                record["traced_peak_mb"] = (traced_peak - traced_start) / 1024.0 ** 2
+                self._traced_peak = max(outer_traced, traced_peak)
+            self._records.append(record)
+
+    def finish(self):
+        """Stop the sampling, print the per stage breakdown and write the json trace and cProfile stats"""
+        total = time.perf_counter() - self._t0
+        self._done.set()
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self._cprofile_file)
+            print_info("cProfile stats saved to {}, read them with python -m pstats".format(self._cprofile_file))
+        records = sorted(self._records, key = lambda r: (r["start"], r["depth"]))
+
+        print_info("Profile of the run, {:.3f}s in total, peak RSS {:.1f} MB".format(total, get_memory_mb("VmHWM")))
+        for r in records:
+            rows = "{:>11} rows {:>11.0f} rows/s".format(r["rows"], r["rows_per_second"]) \
+                if "rows_per_second" in r else " " * 33
+            traced = ", python {:>8.1f} MB".format(r["traced_peak_mb"]) if "traced_peak_mb" in r else ""
+            print_info("{:<24} {:>9.3f}s {:>5.1f}% {} peak RSS {:>8.1f} MB{}".format("  " * r["depth"] + r["name"], \
+                r["seconds"], 100.0 * r["seconds"] / max(total, 1e-9), rows, r["peak_rss_mb"], traced))
+
+        if self._trace_file:
+            # traceEvents is the Chrome trace format, the file opens in chrome://tracing or ui.perfetto.dev
+            events = [{"name": r["name"], "ph": "X", "ts": r["start"] * 1e6, "dur": r["seconds"] * 1e6,
+                       "pid": os.getpid(), "tid": 0, "args": {k: v for k, v in r.items() if k not in ("name", "start", "seconds")}}
+                      for r in records]
+            with open(self._trace_file, "w") as fp:
+                json.dump({"argv": sys.argv, "total_seconds": total, "peak_rss_mb": get_memory_mb("VmHWM"),
+                           "stages": records, "traceEvents": events}, fp, indent = 1)
+            print_info("Profile saved to {}".format(self._trace_file))
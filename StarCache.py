@@ -0,0 +1,123 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#           Binary sidecar cache of parsed star files                      #
+############################################################################
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from MyTools import *
+
+# Every cached star file gets its own folder in the cache directory:
+#   meta.json       source path/size/mtime, star file header and column layout
+#   <nr>.npy        numeric column, memory-mapped on load
+#   <nr>.codes.npy  string column stored as codes into the unique values
+#   <nr>.txt        newline separated unique values of a string column
+# Column 0 is the index of the DataFrame.
+
+def get_entry_dir(filename, cache_dir):
+    key = hashlib.sha1(os.path.abspath(filename).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, key)
+
+def get_file_signature(filename):
+    st = os.stat(filename)
+    return {"source": os.path.abspath(filename), "size": st.st_size, "mtime": st.st_mtime_ns}
+
+def get_dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+def load_sidecar(filename, cache_dir, columns = None):
+    """
+        Return (header, DataFrame) of a cached star file, or None if there is no valid sidecar.
+        With columns given, only the index and these columns are loaded.
+    """
+    if not os.path.isfile(filename):
+        return None
+    entry = get_entry_dir(filename, cache_dir)
+    meta_file = os.path.join(entry, "meta.json")
+    try:
+        with open(meta_file) as fp:
+            meta = json.load(fp)
+    except (IOError, ValueError):
+        return None
+    if meta["signature"] != get_file_signature(filename):
+        print_info("Cached copy of {} is outdated, removing it".format(filename))
+        shutil.rmtree(entry, ignore_errors = True)
+        return None
+
+    data = {}
+    try:
+        for nr, (col, kind) in enumerate(meta["columns"]):
+            if nr and columns is not None and col not in columns:
+                continue
+            path = os.path.join(entry, str(nr))
+            if kind == "str":
+                codes = np.load(path + ".codes.npy", mmap_mode = "r")
+                with open(path + ".txt", encoding = "utf-8") as fp:
+                    uniques = pd.Series(fp.read().split("\n"), dtype = str)
+                # dtype str as the parser gives it, object before pandas 3
+                data[col] = uniques.take(codes).reset_index(drop = True)
+            else:
+                data[col] = np.load(path + ".npy", mmap_mode = "r")
+    except (IOError, ValueError):
+        # The entry is being replaced by another run
+        return None
+    idx = meta["columns"][0][0]
+    df = pd.DataFrame(data, copy = False).set_index(idx)
+    # Mark the entry as recently used for the LRU eviction
+    os.utime(meta_file)
+    print_info("Loaded {} from cache {}".format(filename, entry))
+    return meta["header"], df
+
+def save_sidecar(filename, cache_dir, header, df, max_size = 0):
+    """Write the parsed star file into the cache, then shrink the cache to max_size bytes"""
+    entry = get_entry_dir(filename, cache_dir)
+    tmp = entry + ".tmp{}".format(os.getpid())
+    os.makedirs(tmp, exist_ok = True)
+    columns = []
+    for nr, (col, values) in enumerate([(df.index.name, df.index)] + list(df.items())):
+        path = os.path.join(tmp, str(nr))
+        if not pd.api.types.is_numeric_dtype(values.dtype):
+            codes, uniques = pd.factorize(values)
+            np.save(path + ".codes.npy", codes.astype(np.int64))
+            with open(path + ".txt", "w", encoding = "utf-8") as fp:
+                fp.write("\n".join(map(str, uniques)))
+            columns.append((col, "str"))
+        else:
+            np.save(path + ".npy", np.asarray(values))
+            columns.append((col, str(values.dtype)))
+    meta = {"signature": get_file_signature(filename), "header": header, "columns": columns}
+    with open(os.path.join(tmp, "meta.json"), "w") as fp:
+        json.dump(meta, fp)
+    shutil.rmtree(entry, ignore_errors = True)
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # Another run cached the same star file at the same time, keep its entry
+        shutil.rmtree(tmp, ignore_errors = True)
+    if max_size:
+        evict_lru(cache_dir, max_size, keep = entry)
+
+def evict_lru(cache_dir, max_size, keep = ""):
+    """Remove the least recently used entries until the cache is smaller than max_size bytes"""
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        meta_file = os.path.join(entry, "meta.json")
+        if os.path.isfile(meta_file):
+            entries.append((os.path.getmtime(meta_file), get_dir_size(entry), entry))
+    total = sum(e[1] for e in entries)
+    for mtime, size, entry in sorted(entries):
+        if total <= max_size:
+            break
+        if entry == keep:
+            continue
+        shutil.rmtree(entry, ignore_errors = True)
+        total -= size
+        print_info("Evicted {} from cache".format(entry))
@@ -0,0 +1,248 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#           Header of star files, without pandas or numpy                  #
+############################################################################
+import mmap
+import os
+from MyTools import *
+from StarStream import get_compression, open_star_file
+
+_star_indexes = {}
+
+class StarIndex():
+    """
+        Byte offsets of the data_ blocks of a star file, e.g. data_optics and data_particles of a particle
+        star file, or data_model_general, data_model_classes, ... of a model star file. Every block is a
+        dictionary with
+            name          the block name without "data_", "" for a bare data_
+            offset        byte offset of the data_ line
+            loop          True for a loop_ block, False for a list of "_label value" pairs
+            columns       labels of the loop without the leading "_"
+            values        label -> value of a block which is not a loop
+            label_offset  byte offset of the first label line
+            data_offset   byte offset of the first row of the loop
+            data_line     number of lines before the first row of the loop, i.e. skiprows of pandas
+            end           byte offset of the next data_ line, or the size of the file. None until needed
+                          for the last indexed loop
+        The file is indexed lazily, only as far as the requested block, and the rows of a loop are not
+        read but skipped with a search for the next data_ line, so finding a small block in a huge file
+        costs a few header lines.
+        The offsets of a .gz/.zst star file refer to the decompressed bytes, its rows are decompressed to
+        be skipped.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._compressed = get_compression(filename) is not None
+        # The decompressed size is known once the end of the file is reached
+        self._size = None if self._compressed else os.path.getsize(filename)
+        self._blocks = []
+        self._pos = 0
+        self._line = 0
+
+    def _index_next_block(self):
+        """Index the block starting at or after the current position, False at the end of the file"""
+        if self._blocks and self._blocks[-1]["end"] is None:
+            self._find_end(self._blocks[-1])
+        if self._size is not None and self._pos >= self._size:
+            return False
+        block = None
+        with self.open() as f:
+            f.seek(self._pos)
+            pos, line = self._pos, self._line
+            while True:
+                ln = f.readline()
+                if not ln:
+                    self._size = pos
+                    break
+                if ln.startswith(b"data_"):
+                    if block is not None:
+                        break
+                    block = {"name": ln[5:].strip().decode("utf-8", "replace"), "offset": pos, "loop": False,
+                             "columns": [], "values": {}, "label_offset": None, "data_offset": None,
+                             "data_line": None}
+                elif block is not None and not ln.startswith(b"#") and ln.strip():
+                    if ln.startswith(b"loop_"):
+                        block["loop"] = True
+                    elif ln.startswith(b"_"):
+                        if block["label_offset"] is None:
+                            block["label_offset"] = pos
+                        fields = ln.decode("utf-8", "replace").split(None, 1)
+                        if block["loop"]:
+                            block["columns"].append(fields[0][1:])
+                        else:
+                            block["values"][fields[0][1:]] = fields[1].strip() if len(fields) > 1 else ""
+                    elif block["loop"]:
+                        # The end of the rows is only looked for when a later block is needed
+                        block["data_offset"], block["data_line"] = pos, line
+                        block["end"] = None
+                        self._blocks.append(block)
+                        self._pos, self._line = pos, line
+                        return True
+                pos += len(ln)
+                line += 1
+        if block is None:
+            self._pos, self._line = pos, line
+            return False
+        block["end"] = pos
+        self._blocks.append(block)
+        self._pos, self._line = pos, line
+        return True
+
+    def open(self):
+        """Binary stream of the (decompressed) star file, which can be seeked forward"""
+        if self._compressed:
+            return open_star_file(self._filename, "rb", threaded = False)
+        return open(self._filename, "rb")
+
+    def get_size(self):
+        """Size of the (decompressed) star file, None if the end of a compressed file hasn't been reached"""
+        return self._size
+
+    def _find_end(self, block):
+        """Jump from the first row of the last indexed loop to the next data_ line"""
+        pos = block["data_offset"]
+        if self._compressed:
+            end, lines = self._find_end_stream(pos)
+        else:
+            with open(self._filename, "rb") as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+                end = mm.find(b"\ndata_", pos)
+                lines = 0
+                if end < 0:
+                    # Nothing follows the loop, the lines are only counted to index a next block
+                    end = self._size
+                else:
+                    end += 1
+                    for start in range(pos, end, 1 << 26):
+                        lines += mm[start:min(end, start + (1 << 26))].count(b"\n")
+        block["end"] = end
+        self._pos, self._line = end, block["data_line"] + lines
+
+    def _find_end_stream(self, pos):
+        # Same search on the decompressed stream, tail keeps a "\ndata_" cut in two by the blocks
+        lines, tail, offset, size = 0, b"", pos, 1 << 16
+        with self.open() as f:
+            f.seek(pos)
+            while True:
+                # Small reads first, the next data_ line of a small loop is close by
+                chunk = f.read(size)
+                size = min(size * 2, 1 << 24)
+                if not chunk:
+                    self._size = offset
+                    return offset, lines
+                buf = tail + chunk
+                i = buf.find(b"\ndata_")
+                if i >= 0:
+                    lines += buf[len(tail):i + 1].count(b"\n")
+                    return offset - len(tail) + i + 1, lines
+                lines += chunk.count(b"\n")
+                offset += len(chunk)
+                tail = buf[-5:]
+
+    def get_end(self, block):
+        """Byte offset where the block ends, the rows of a loop are skipped over to find it if needed"""
+        if block["end"] is None:
+            self._find_end(block)
+        return block["end"]
+
+    def get_blocks(self):
+        """Index the whole file and return all the blocks"""
+        while self._index_next_block():
+            pass
+        return self._blocks
+
+    def get_block(self, name, scan = True):
+        """The block data_name, None if the file has no such block. With scan False, only the blocks indexed so far are searched"""
+        for block in self._blocks:
+            if block["name"] == name:
+                return block
+        while scan and self._index_next_block():
+            if self._blocks[-1]["name"] == name:
+                return self._blocks[-1]
+        return None
+
+    def find_block(self, condition):
+        """The first block for which condition(block) is True, None if there is none"""
+        for block in self._blocks:
+            if condition(block):
+                return block
+        while self._index_next_block():
+            if condition(self._blocks[-1]):
+                return self._blocks[-1]
+        return None
+
+    def read_lines(self, block, start = "label_offset"):
+        """Raw label and row lines of a block from the offset start on, without comments and blank lines"""
+        if block[start] is None:
+            return []
+        self.get_end(block)
+        with self.open() as f:
+            f.seek(block[start])
+            text = f.read(block["end"] - block[start]).decode("utf-8")
+        return [ln + "\n" for ln in text.split("\n") if ln.strip() and not ln.startswith("#") and not ln.startswith("loop_")]
+
+    def read_table(self, name):
+        """(columns, rows) of the loop data_name, every row as a list of strings. Meant for small blocks"""
+        block = self.get_block(name)
+        if block is None:
+            print_error("{} has no data_{} block".format(self._filename, name))
+        return block["columns"], [ln.split() for ln in self.read_lines(block, "data_offset")]
+
+def get_star_index(filename):
+    """The StarIndex of filename, indexed again only when the file has been modified"""
+    key = os.path.abspath(filename)
+    st = os.stat(filename)
+    if key not in _star_indexes or _star_indexes[key][0] != (st.st_size, st.st_mtime_ns):
+        _star_indexes[key] = ((st.st_size, st.st_mtime_ns), StarIndex(filename))
+    return _star_indexes[key][1]
+
+def read_star_header(filename, optics_after = False):
+    """
+        Find the optics block and the main loop (the first other loop, data_particles of a particle star
+        file) of a star file and return a dictionary with
+            version             "3.1" if there is a data_optics block, "3.0" otherwise
+            optics_header       "data_optics\nloop_\n" or ""
+            optics              lines of the optics loop, labels and rows
+            particles_header    "data_particles\nloop_\n", or "data_\nloop_\n" for RELION 3.0
+            particles_columns   labels of the main loop without the leading "_"
+            particle_start_nr   number of lines before the first row of the main loop
+            particles_end       byte offset where the main loop ends if another block follows it, None
+                                if it runs to the end of the file
+        Only the header is read, RELION writes the optics block before the main loop. With optics_after,
+        the rows of the main loop are skipped over to look for a data_optics block after it too.
+    """
+    try:
+        index = get_star_index(filename)
+        main = index.find_block(lambda b: b["loop"] and b["name"] != "optics")
+        optics = index.get_block("optics", scan = optics_after or main is None)
+        # The end of the main loop is only known once the file was scanned past it for the optics block
+        end = main["end"] if main is not None else None
+        particles_end = end if end is not None and end != index.get_size() else None
+    except (IOError, ValueError):
+        print_error("Failed to read {}".format(filename))
+    header = {"version": "3.0", "optics_header": "", "optics": [], "particles_header": "",
+              "particles_columns": [], "particle_start_nr": 0, "particles_end": particles_end}
+    if optics is not None:
+        header["version"] = "3.1"
+        header["optics_header"] = "data_optics\nloop_\n"
+        header["optics"] = index.read_lines(optics)
+    if main is not None:
+        header["particles_header"] = "data_{}\nloop_\n".format(main["name"])
+        header["particles_columns"] = list(main["columns"])
+        header["particle_start_nr"] = main["data_line"] if main["data_line"] is not None else 0
+    return header
+
+def read_star_table(filename, name):
+    """(columns, rows) of the loop data_name of a star file, e.g. data_model_classes of a model star file"""
+    return get_star_index(filename).read_table(name)
+
+def get_optics_table(optics):
+    """Return (labels, rows) of the lines of an optics loop, every row as a list of strings"""
+    labels = [ln.split()[0][1:] for ln in optics if ln.startswith("_")]
+    rows = [ln.split() for ln in optics if not ln.startswith("_") and ln.strip()]
+    return labels, rows
+
+def get_optics_groups(optics):
+    """The rows of an optics loop as dictionaries from label to value, the values are left as strings"""
+    labels, rows = get_optics_table(optics)
+    return [dict(zip(labels, row)) for row in rows]
@@ -0,0 +1,112 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#     Set operations on the particles of star/cs files, out of core        #
+############################################################################
+import functools
+import os
+import numpy as np
+import pandas as pd
+from MyTools import *
+from STAR import encode_particle_keys
+
+# Number of keys read from the sorted files at a time when they are merged
+MERGE_BLOCK = 1 << 20
+
+class KeyEncoder():
+    """
+        int64 keys of particles which are the same across files, by image name (see encode_particle_keys)
+        or by micrograph name. The stack paths or micrographs are numbered while the primary star file
+        is encoded (add True). Particles of any other stack or micrograph can't be in the output, they
+        get the key -1.
+    """
+    def __init__(self, by = "image"):
+        self._by = by
+        self._ids = {}
+
+    def encode(self, names, add = False):
+        if self._by == "image":
+            encoded = encode_particle_keys(names)
+            if encoded is None:
+                print_error("Set operations by image need particle names like 000001@path/stack.mrcs")
+            keys, labels = encoded
+            local = keys >> 32
+        else:
+            local, labels = pd.factorize(np.asarray(names, dtype = object))
+        if add:
+            ids = np.array([self._ids.setdefault(l, len(self._ids)) for l in labels], dtype = np.int64)
+        else:
+            ids = np.array([self._ids.get(l, -1) for l in labels], dtype = np.int64)
+        ids = ids[local] if len(ids) else np.full(len(local), -1, np.int64)
+        if self._by == "image":
+            return np.where(ids < 0, -1, (ids << 32) | (keys & 0xFFFFFFFF))
+        return ids
+
+def write_keys(keys, filename):
+    """Save the distinct valid keys, sorted, as raw int64"""
+    np.unique(keys[keys >= 0]).tofile(filename)
+
+def read_keys(filename):
+    """Memory map of a file of sorted keys"""
+    if os.path.getsize(filename) == 0:
+        return np.empty(0, np.int64)
+    return np.memmap(filename, dtype = np.int64, mode = "r")
+
+def count_keys(filename):
+    return os.path.getsize(filename) // 8
+
+def merge_keys(inputs, output, op = "union", block = MERGE_BLOCK):
+    """
+        Merge files of sorted distinct keys into output, sorted and distinct as well:
+            union      keys of any of the inputs
+            intersect  keys of all the inputs
+            minus      keys of the first input which are in none of the others
+        Only a block of every input is in memory at a time, in rounds: every round takes the keys up
+        to the smallest last key of the blocks, so the inputs are consumed side by side.
+    """
+    arrays = [read_keys(f) for f in inputs]
+    pos = [0] * len(arrays)
+    block = max(1, block // max(len(arrays), 1))
+    with open(output, "wb") as fp:
+        while True:
+            active = [i for i, a in enumerate(arrays) if pos[i] < len(a)]
+            if not active or (op == "intersect" and len(active) < len(arrays)) or (op == "minus" and 0 not in active):
+                break
+            hi = min(arrays[i][min(pos[i] + block, len(arrays[i])) - 1] for i in active)
+            pieces = []
+            for i, a in enumerate(arrays):
+                window = np.asarray(a[pos[i]:pos[i] + block])
+                n = np.searchsorted(window, hi, side = "right")
+                pieces.append(window[:n])
+                pos[i] += n
+            if op == "union":
+                out = np.unique(np.concatenate(pieces))
+            elif op == "intersect":
+                out = functools.reduce(lambda a, b: np.intersect1d(a, b, assume_unique = True), pieces)
+            elif op == "minus":
+                out = pieces[0] if len(pieces) == 1 else pieces[0][~np.isin(pieces[0], np.concatenate(pieces[1:]))]
+            else:
+                print_error("Unknown set operation {}".format(op))
+            fp.write(out.tobytes())
+    return output
+
+def sort_keys(chunks, encoder, output, add = False):
+    """
+        External sort of the keys of the names in chunks (an iterable of arrays of names): every chunk is
+        saved as a sorted run next to output, then the runs are merged into output
+    """
+    runs = []
+    try:
+        for names in chunks:
+            runs.append("{}.run{}".format(output, len(runs)))
+            write_keys(encoder.encode(names, add = add), runs[-1])
+        return merge_keys(runs, output, "union")
+    finally:
+        for run in runs:
+            os.remove(run)
+
+def isin_keys(keys, sorted_keys):
+    """Boolean mask of keys found in the (memory mapped) sorted keys"""
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), bool)
+    pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return np.asarray(sorted_keys[pos]) == keys
@@ -0,0 +1,216 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#           Reading and writing gzip/zstd compressed star files            #
+############################################################################
+import gzip
+import io
+import queue
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from MyTools import *
+
+# Decompressed/uncompressed bytes handed over between threads at a time
+BLOCK_SIZE = 1 << 22
+
+def get_compression(filename):
+    """"gz" for .gz files, "zst" for .zst files, None for plain text"""
+    if filename.endswith(".gz"):
+        return "gz"
+    elif filename.endswith(".zst"):
+        return "zst"
+    return None
+
+def strip_compression(filename):
+    """filename without its .gz/.zst suffix, e.g. particles.star.gz -> particles.star"""
+    compression = get_compression(filename)
+    return filename[:-len(compression) - 1] if compression else filename
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        print_error("Reading and writing .zst files needs the zstandard package, try pip install zstandard")
+    return zstandard
+
+def open_star_file(filename, mode = "rb", jobs = 1, threaded = True, size = None):
+    """
+        Open a plain, .gz or .zst star file.
+        Reading ("rb") returns a binary stream of the decompressed bytes. With threaded True the file is
+        decompressed by a background thread, ahead of the parsing; with threaded False the stream can be
+        seeked forward, as the star file index needs. With size set, the stream ends after size bytes.
+        Writing ("w") returns a text stream, jobs threads compress it.
+    """
+    compression = get_compression(filename)
+    if mode == "rb" and size is not None:
+        return io.BufferedReader(BoundedReader(open_star_file(filename, threaded = threaded), size), buffer_size = BLOCK_SIZE)
+    if mode == "rb":
+        if compression is None:
+            return open(filename, "rb", buffering = BLOCK_SIZE)
+        if compression == "gz":
+            raw = gzip.open(filename, "rb")
+        else:
+            fp = open(filename, "rb")
+            raw = import_zstandard().ZstdDecompressor().stream_reader(fp, read_size = BLOCK_SIZE, closefd = True)
+        if threaded:
+            return io.BufferedReader(ThreadedReader(raw), buffer_size = BLOCK_SIZE)
+        # The zstd reader has neither readline nor a seek that BufferedReader accepts
+        return raw if compression == "gz" else io.BufferedReader(ForwardSeekReader(raw), buffer_size = BLOCK_SIZE)
+    elif mode == "w":
+        if compression is None:
+            return open(filename, "w", buffering = BLOCK_SIZE)
+        if compression == "gz":
+            raw = ParallelGzipWriter(open(filename, "wb"), jobs = jobs)
+        else:
+            zstd = import_zstandard().ZstdCompressor(level = 3, threads = jobs if jobs > 1 else 0)
+            raw = zstd.stream_writer(open(filename, "wb"), closefd = True)
+        return io.TextIOWrapper(io.BufferedWriter(raw, buffer_size = BLOCK_SIZE), encoding = "utf-8")
+    print_error("Unknown mode {} to open {}".format(mode, filename))
+
+class ThreadedReader(io.RawIOBase):
+    """
+        Read a decompressing stream in a background thread, a few blocks ahead of the consumer. zlib and
+        zstd release the GIL, so the decompression runs alongside the parsing.
+    """
+    def __init__(self, raw, depth = 4):
+        self._raw = raw
+        self._queue = queue.Queue(maxsize = depth)
+        self._stop = threading.Event()
+        self._buffer = b""
+        self._eof = False
+        self._thread = threading.Thread(target = self._fill, daemon = True)
+        self._thread.start()
+
+    def _fill(self):
+        try:
+            while not self._stop.is_set():
+                block = self._raw.read(BLOCK_SIZE)
+                self._put(block)
+                if not block:
+                    break
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout = 0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer and not self._eof:
+            block = self._queue.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                self._eof = True
+            self._buffer = block
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._raw.close()
+        super().close()
+
+class ForwardSeekReader(io.RawIOBase):
+    """
+        Raw stream over a zstd stream reader, which can only seek forward but says it can't seek at all,
+        so that io.BufferedReader reads lines from it and seeks forward as the star file index needs
+    """
+    def __init__(self, raw):
+        self._raw = raw
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        return self._raw.readinto(b)
+
+    def seek(self, pos, whence = io.SEEK_SET):
+        return self._raw.seek(pos, whence)
+
+    def tell(self):
+        return self._raw.tell()
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+        super().close()
+
+class BoundedReader(io.RawIOBase):
+    """The first size bytes of a binary stream, e.g. a star file up to the end of one of its blocks"""
+    def __init__(self, raw, size):
+        self._raw = raw
+        self._left = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._left <= 0:
+            return 0
+        n = self._raw.readinto(memoryview(b)[:min(len(b), self._left)])
+        self._left -= n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+        super().close()
+
+def compress_gzip_member(data, level):
+    c = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return c.compress(data) + c.flush()
+
+class ParallelGzipWriter(io.RawIOBase):
+    """
+        Write a gzip file as a series of gzip members of BLOCK_SIZE bytes each, compressed by a pool of
+        jobs threads and written in order, like pigz. gzip, zcat and python read such files as one stream.
+    """
+    def __init__(self, fp, jobs = 1, level = 6):
+        self._fp = fp
+        self._jobs = max(1, jobs)
+        self._level = level
+        self._pool = ThreadPoolExecutor(max_workers = self._jobs)
+        self._pending = deque()
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buffer += b
+        while len(self._buffer) >= BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:BLOCK_SIZE]))
+            del self._buffer[:BLOCK_SIZE]
+        return len(b)
+
+    def _submit(self, data):
+        self._pending.append(self._pool.submit(compress_gzip_member, data, self._level))
+        while len(self._pending) > 2 * self._jobs:
+            self._fp.write(self._pending.popleft().result())
+
+    def close(self):
+        if not self.closed:
+            if self._buffer or not self._pending:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._fp.write(self._pending.popleft().result())
+            self._pool.shutdown()
+            self._fp.close()
+        super().close()
@@ -0,0 +1,21 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#      Synthetic files of the benchmarks, sized by $ROCKSTAR_BENCHMARK_N    #
+############################################################################
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(scope = "session")
+def synthetic_dir(tmp_path_factory):
+    """
+        Folder of the synthetic files, $ROCKSTAR_BENCHMARK_DIR keeps them for later runs since the big
+        ones take a while to write
+    """
+    folder = os.environ.get("ROCKSTAR_BENCHMARK_DIR")
+    if not folder:
+        return str(tmp_path_factory.mktemp("synthetic"))
+    os.makedirs(folder, exist_ok = True)
+    return folder
@@ -0,0 +1,25 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#      Timings and peak memory of rockstar.py modes and STAR methods       #
+############################################################################
+import os
+import pytest
+import Benchmark
+
+pytest.importorskip("pytest_benchmark")
+
+# Numbers of particles of the synthetic star files, e.g. ROCKSTAR_BENCHMARK_N=10000,1000000
+PARTICLE_NUMBERS = [int(n) for n in os.environ.get("ROCKSTAR_BENCHMARK_N", "10000").split(",")]
+
+@pytest.mark.parametrize("n", PARTICLE_NUMBERS)
+@pytest.mark.parametrize("version", ["3.0", "3.1"])
+@pytest.mark.parametrize("case", Benchmark.CASES)
+def test_case(benchmark, synthetic_dir, tmp_path, case, version, n):
+    """
+        Every round runs the case in a fresh process. The seconds of pytest-benchmark include starting
+        python, extra_info keeps the seconds of the STAR method alone (op) and the peak RSS of the process.
+    """
+    files = Benchmark.generate(synthetic_dir, n, version)
+    timings = benchmark.pedantic(Benchmark.run_case_process, args = (case, files, str(tmp_path / "output.star")), \
+        rounds = 3, iterations = 1)
+    benchmark.extra_info.update(timings)
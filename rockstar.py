@@ -3,29 +3,232 @@
 #   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
 #               Tested on Python 3.8.8 Pandas v0.22.0                      #
 ############################################################################
-from STAR import *
+import argparse
+import json
+import os
+from MyTools import *
+from StarHeader import read_star_header, get_optics_groups
+from StarStream import strip_compression
 
 def getImageName(filename,filepath = ""):
+    """
+        Build rlnImageName of every particle in a cryosparc cs file. The cs file is memory-mapped and only
+        the blob/idx and blob/path fields are read, each particle stack path is decoded once.
+    """
+    import numpy as np
+    import pandas as pd
     try:
-        cs = np.load(filename)
-        image_list = []
-        for row in cs:
-            idx = "{:06d}".format(int(row["blob/idx"]) + 1)
-            filename = row["blob/path"].decode("utf-8").split("/")[-1]
-            image_list.append(idx + "@" + filepath + "/" + filename)
-        return image_list
-    except KeyError:
+        cs = np.load(filename, mmap_mode = "r")
+        if len(cs) == 0:
+            return []
+        stack_nr, stacks = pd.factorize(cs["blob/path"])
+        stacks = np.array([filepath + "/" + p.decode("utf-8").split("/")[-1] for p in stacks], dtype = object)
+        idx = cs["blob/idx"].astype(np.int64)
+        slices = np.array(["{:06d}@".format(i + 1) for i in range(idx.max() + 1)], dtype = object)
+        return (slices[idx] + stacks[stack_nr]).tolist()
+    except (KeyError, ValueError):
         print_error("Something went wrong when extracts rlnImageName from cs file")
 
-def ArgumentParse():
-    parser = argparse.ArgumentParser(fromfile_prefix_chars='@',formatter_class=argparse.RawDescriptionHelpFormatter,\
+# Set by the rockstar server (RockServer.py), which keeps the parsed star files in memory
+star_loader = None
+
+def open_star(filename, **kwargs):
+    """STAR(filename, **kwargs), or a copy of the parsed star file kept by the rockstar server"""
+    if star_loader is not None:
+        return star_loader(filename, **kwargs)
+    from STAR import STAR
+    return STAR(filename, **kwargs)
+
+def load_star(args, filename, **kwargs):
+    """Open a star file with the streaming/cache settings given on the command line"""
+    kwargs.setdefault("chunksize", args.chunksize)
+    return open_star(filename, cache_dir = args.cache, cache_size = args.cache_size * 1024 ** 2, \
+        optics_after = args.optics_after, **kwargs)
+
+def get_micrograph_names(filename, chunksize = 0):
+    """Worker of the exclude mode, returns the set of micrographs used in one star file"""
+    star = open_star(filename, chunksize = chunksize, idx = None, columns = ['rlnMicrographName'])
+    return set(star.get_column_content('rlnMicrographName'))
+
+def get_file_type(filename):
+    """"star" for star files, compressed or not, "cs" for cryosparc files, None for any other file"""
+    if strip_compression(filename).endswith(".star"):
+        return "star"
+    elif filename.endswith(".cs"):
+        return "cs"
+    return None
+
+def load_manifest(filename):
+    """
+        Read the operations of batch mode from a json or yaml file, either a list or {"outputs": list}.
+        Every operation is a dictionary with the output star file "o", and "subset" (a star/cs file)
+        and/or "exclude" (a star file or a list of them).
+    """
+    try:
+        with open(filename) as fp:
+            if filename.endswith((".yaml", ".yml")):
+                try:
+                    import yaml
+                except ImportError:
+                    print_error("Reading yaml manifests needs the PyYAML package, try pip install pyyaml or use json")
+                manifest = yaml.safe_load(fp)
+            else:
+                manifest = json.load(fp)
+    except (IOError, ValueError) as e:
+        print_error("Failed to read the manifest {}: {}".format(filename, e))
+    operations = manifest.get("outputs") if isinstance(manifest, dict) else manifest
+    if not isinstance(operations, list) or not operations:
+        print_error("The manifest {} has no list of outputs".format(filename))
+    outputs = set()
+    for op in operations:
+        if not isinstance(op, dict) or not op.get("o"):
+            print_error("Every output of the manifest needs an output file o: {}".format(op))
+        if not op.get("subset") and not op.get("exclude"):
+            print_error("Output {} needs a subset and/or exclude".format(op["o"]))
+        if isinstance(op.get("exclude"), str):
+            op["exclude"] = [op["exclude"]]
+        if op.get("subset") and get_file_type(op["subset"]) is None:
+            print_error("Unsupported subset file type: {}".format(op["subset"]))
+        if os.path.exists(op["o"]) or op["o"] in outputs:
+            print_error("You provided a filename which was taken by another file: {}".format(op["o"]))
+        outputs.add(op["o"])
+    return operations
+
+_batch_star = None
+
+def init_batch_writer(star):
+    # With fork the parent star file is inherited by the writers, not pickled
+    global _batch_star
+    _batch_star = star
+
+def write_batch_output(output, rows, jobs = 1):
+    """Worker of the batch mode, writes the rows of the parent star file to output"""
+    _batch_star.to_star(output, chunks = [_batch_star.get_rows(rows)], jobs = jobs)
+    return output, len(rows)
+
+def run_batch(args):
+    """
+        Batch mode: the parent star file is parsed once and every output of the manifest is a lookup of
+        row positions in it, through the particle keys and micrograph codes built once as well.
+    """
+    import numpy as np
+    from StageProfiler import stage
+    operations = load_manifest(args.manifest)
+    if args.chunksize:
+        print_warning("Batch mode loads the input star file at once, --chunksize is ignored")
+        args.chunksize = 0
+    with stage("input"):
+        parent = load_star(args, args.i)
+    micrograph_names, subsets, results = {}, {}, []
+    for op in operations:
+        with stage("batch " + op["o"]) as st:
+            rows = np.arange(parent.get_particle_nr())
+            if op.get("subset"):
+                f = op["subset"]
+                if f not in subsets:
+                    if get_file_type(f) == "star":
+                        subsets[f] = load_star(args, f, columns = []).get_index()
+                    else:
+                        subsets[f] = getImageName(f, filepath = parent.get_particles_path())
+                rows = parent.get_row_positions(subsets[f])
+            if op.get("exclude"):
+                micrographs = set()
+                for f in op["exclude"]:
+                    if f not in micrograph_names:
+                        micrograph_names[f] = get_micrograph_names(f)
+                    micrographs.update(micrograph_names[f])
+                codes, uniques = parent.get_column_codes('rlnMicrographName')
+                excluded = uniques.isin(list(micrographs))[codes]
+                rows = rows[~excluded[rows]]
+            st["rows"] = len(rows)
+        results.append((op["o"], rows))
+    if args.jobs > 1 and len(results) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with stage("write outputs"), ProcessPoolExecutor(max_workers = min(args.jobs, len(results)), \
+                initializer = init_batch_writer, initargs = (parent,)) as pool:
+            for output, n in pool.map(write_batch_output, *zip(*results)):
+                print_info("{} particles in {}".format(n, output))
+    else:
+        init_batch_writer(parent)
+        for output, rows in results:
+            write_batch_output(output, rows, jobs = args.jobs)
+            print_info("{} particles in {}".format(len(rows), output))
+
+def iter_key_names(filename, key, chunksize, particles_path = ""):
+    """Particle names (key "image") or micrograph names (key "micrograph") of a star/cs file, chunk by chunk"""
+    if get_file_type(filename) is None:
+        print_error("Unsupported file type: {}".format(filename))
+    elif get_file_type(filename) == "cs":
+        if key != "image":
+            print_error("cs files can only be combined by image name: {}".format(filename))
+        names = getImageName(filename, filepath = particles_path)
+        for i in range(0, len(names), chunksize):
+            yield names[i:i + chunksize]
+    elif key == "image":
+        for chunk in open_star(filename, chunksize = chunksize, columns = []).iter_chunks():
+            yield chunk.index
+    else:
+        star = open_star(filename, chunksize = chunksize, idx = None, columns = ['rlnMicrographName'])
+        for chunk in star.iter_chunks():
+            yield chunk['rlnMicrographName'].to_numpy()
+
+def run_set_operations(args):
+    """
+        Set mode: the particles of the input star file whose key (image or micrograph name) is in the
+        union of the --union files (all of the input star file without them), in every --intersect
+        file and in none of the --minus files. The keys of every file are sorted on disk in runs of
+        --chunksize particles and merged, so no file is ever loaded at once.
+    """
+    import shutil
+    import tempfile
+    from StageProfiler import stage
+    from StarSets import KeyEncoder, sort_keys, merge_keys, read_keys, count_keys, isin_keys
+    union, intersect, minus = [sum(files or [], []) for files in (args.union, args.intersect, args.minus)]
+    chunksize = args.chunksize or 500000
+    primary = open_star(args.i, chunksize = chunksize, optics_after = args.optics_after)
+    particles_path = primary.get_particles_path() if args.key == "image" else ""
+    encoder = KeyEncoder(args.key)
+    # The sorted runs can be as big as the star files, keep them next to the output rather than in /tmp
+    folder = tempfile.mkdtemp(prefix = ".rockstar_set_", dir = os.path.dirname(os.path.abspath(args.o)))
+    try:
+        def sort_file(f, name, add = False):
+            with stage("sort " + name) as st:
+                output = sort_keys(iter_key_names(f, args.key, chunksize, particles_path), encoder, \
+                    os.path.join(folder, name), add = add)
+                st["rows"] = count_keys(output)
+            print_info("{} distinct {} keys in {}".format(count_keys(output), args.key, f))
+            return output
+
+        selected = sort_file(args.i, "input", add = True)
+        if union:
+            runs = [sort_file(f, "union{}".format(i)) for i, f in enumerate(union)]
+            selected = merge_keys(runs, os.path.join(folder, "union"), "union")
+        if intersect:
+            runs = [sort_file(f, "intersect{}".format(i)) for i, f in enumerate(intersect)]
+            selected = merge_keys([selected] + runs, os.path.join(folder, "intersect"), "intersect")
+        if minus:
+            runs = [sort_file(f, "minus{}".format(i)) for i, f in enumerate(minus)]
+            selected = merge_keys([selected] + runs, os.path.join(folder, "minus"), "minus")
+        print_info("{} {} keys are selected".format(count_keys(selected), args.key))
+
+        selected = read_keys(selected)
+        def iter_selected():
+            for chunk in primary.iter_chunks():
+                names = chunk.index if args.key == "image" else chunk['rlnMicrographName'].to_numpy()
+                yield chunk[isin_keys(encoder.encode(names), selected)]
+        primary.to_star(args.o, chunks = iter_selected(), jobs = args.jobs)
+    finally:
+        shutil.rmtree(folder, ignore_errors = True)
+
+def ArgumentParse(argv = None):
+    parser = argparse.ArgumentParser(prog = "rockstar.py", fromfile_prefix_chars='@',formatter_class=argparse.RawDescriptionHelpFormatter,\
                                      description='\033[31mBasic Python Parser for star files\033[0m')
-    parser.add_argument("mode", choices = ["subset", "hr", "exclude" ],\
+    parser.add_argument("mode", choices = ["subset", "hr", "exclude", "info", "header", "batch", "set"],\
         type = str, help = "Specify which mode you would like to run")
     parser.add_argument("--i", required = True, metavar = '*.star', type = str, \
         help = "Provide the filename of input star")
-    parser.add_argument("--o", required = True, metavar = '*.star', type = str, \
-        help = "Provide the filename of ouput star")
+    parser.add_argument("--o", required = False, metavar = '*.star', type = str, \
+        help = "Provide the filename of ouput star, or of the json file in info and header mode")
     parser.add_argument("--subset", required = False, metavar = '*.cs', type = str, \
         help = "Provide the filename of subset star/cs file")
     parser.add_argument("--beamshift", required = False, metavar = '*.csv', type = str, \
@@ -38,20 +241,71 @@ def ArgumentParse():
         help = "Provide the dimensionY of micrographs in pixel, the dimension of k2 images is 3838 x 3710")
     parser.add_argument("--scale", required = False, default = '1', metavar='1/2/4', \
         type = str, help = "Provide the scale factor for 2D averages display")
+    parser.add_argument("--auto", action = 'store_true', \
+        help = "In hr mode, find the center of the class averages automatically instead of clicking on them")
+    parser.add_argument("--clicks", required = False, metavar = '*.json', type = str, \
+        help = "In hr mode, replay the class centers saved in this file if it exists, \
+            otherwise save the class centers into it")
+    parser.add_argument("--manifest", required = False, metavar = '*.json/*.yaml', type = str, \
+        help = "In batch mode, the json/yaml file listing the outputs to write from the input star file, \
+            each a subset and/or exclude operation")
+    parser.add_argument("--downscale", required = False, metavar = 'N', type = int, \
+        help = "In hr mode, the downscale factor of the particle stacks of a RELION 3.0 star file, \
+            asked for if it isn't given")
+    parser.add_argument("--duplicates", required = False, metavar = 'PX', type = float, \
+        help = "In hr mode, remove the particles closer than PX pixels to a better particle of the same \
+            micrograph after the recentering")
+    parser.add_argument("--keep_best", required = False, metavar = 'rlnMaxValueProbDistribution', type = str, \
+        help = "With --duplicates, keep the particle with the highest value of this column, \
+            otherwise the one coming first in the star file")
     parser.add_argument("--exclude", action = 'append',metavar = "*.star", nargs = "+", \
         help = "Provide star files to exclude")
+    parser.add_argument("--union", action = 'append', metavar = "*.star/*.cs", nargs = "+", \
+        help = "In set mode, keep the particles of the input star file found in any of these star/cs files")
+    parser.add_argument("--intersect", action = 'append', metavar = "*.star/*.cs", nargs = "+", \
+        help = "In set mode, keep only the particles found in every one of these star/cs files")
+    parser.add_argument("--minus", action = 'append', metavar = "*.star/*.cs", nargs = "+", \
+        help = "In set mode, remove the particles found in any of these star/cs files")
+    parser.add_argument("--key", required = False, default = "image", choices = ["image", "micrograph"], \
+        help = "In set mode, compare the particles by rlnImageName or by rlnMicrographName")
+    parser.add_argument("--chunksize", required = False, default = 0, metavar = 'N', type = int, \
+        help = "Stream star files in chunks of N particles instead of loading them at once, \
+            keeps the memory bounded for huge star files in subset and exclude mode. \
+            In subset mode the particles then come out in the order of the input star file, not of the subset")
+    parser.add_argument("--cache", required = False, metavar = 'DIR', type = str, \
+        help = "Keep a binary copy of the parsed star files in this folder, so that later runs on \
+            the same unchanged star files skip the parsing")
+    parser.add_argument("--cache_size", required = False, default = 10240, metavar = 'MB', type = int, \
+        help = "Maximum size of the cache folder, the least recently used entries are removed first")
+    parser.add_argument("--optics_after", action = 'store_true', \
+        help = "Also look for the optics block after the particles, for star files not written by RELION, \
+            which writes it first. Such a star file is then read to its end to find the header")
+    parser.add_argument("--jobs", required = False, default = 1, metavar = 'N', type = int, \
+        help = "Number of processes used to read the star files given to --exclude and to write the output, \
+            in batch mode the number of outputs written at the same time")
+    parser.add_argument("--profile", required = False, metavar = '*.json', type = str, \
+        help = "Time every stage of the run (header, read, the mode itself, write), print the breakdown \
+            and save it as a json trace")
+    parser.add_argument("--profile_memory", action = 'store_true', \
+        help = "With --profile, also trace the python allocations of every stage, slows the run down")
+    parser.add_argument("--cprofile", required = False, metavar = '*.prof', type = str, \
+        help = "Save the cProfile statistics of the whole run into this file")
     parser.add_argument("--retain_subset_columns", action = 'append', metavar = "rlnOriginX rlnOriginY",\
          nargs = "+", help = "When using subset mode to update subset star file, everything except ImageName\
               is discarded. By specifying this parameters with  column names, \
                   the responding information from subset will be retained.")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if not args.o and args.mode not in ('info', 'header', 'batch'):
+        print_error("Output parameter --o needs to be specified...")
     if args.o:
         if os.path.exists(args.o):
             print_error("You provided a filename which was taken by another file")
     if args.mode == 'subset':
         if not args.subset:
             print_error("Subset parameter needs to be specified...")
+        if get_file_type(args.subset) is None:
+            print_error("Unsupported subset file type, a star or cs file is needed: {}".format(args.subset))
     elif args.mode == 'hr':
         if args.mrcs and args.micsx and args.micsy:
             print_info("Required parameters are present...")
@@ -60,36 +314,70 @@ def ArgumentParse():
     elif args.mode == 'exclude':
         if not args.exclude:
             print_error("Exclude parameters need to be specified...")
+    elif args.mode == 'set':
+        if not (args.union or args.intersect or args.minus):
+            print_error("At least one of --union --intersect --minus needs to be specified...")
+    elif args.mode == 'batch':
+        if not args.manifest:
+            print_error("Manifest parameter needs to be specified...")
+    elif args.mode in ('info', 'header'):
+        pass
     else:
         print_error("Unknown Error")
     return args
 
-#Main
+def main(args):
+    """Run the mode of the parsed command line"""
+    # Header mode reads the header only, it doesn't need pandas or numpy, so they are not even imported
+    if args.mode == 'header':
+        header = read_star_header(args.i, optics_after = args.optics_after)
+        info = {"version": header["version"], "columns": header["particles_columns"], \
+            "optics_groups": get_optics_groups(header["optics"])}
+        print_info("The star file is from RELION {}".format("3.0 or older" if info["version"] == "3.0" else "3.1 or newer"))
+        print_info("Columns of the particles: {}".format(", ".join(info["columns"])))
+        for group in info["optics_groups"]:
+            print_dict(group)
+        if args.o:
+            with open(args.o, "w") as fp:
+                json.dump(info, fp, indent = 1)
+            print_info("Saved to file: {}".format(args.o))
+        return
 
-if __name__ == '__main__':
-
-    args = ArgumentParse()
+    from concurrent.futures import ProcessPoolExecutor
+    from RelionTools import get_image_dimensions, relion_display_parser, auto_class_centers, \
+        save_class_centers, load_class_centers
+    from StageProfiler import enable_profiling, stage
+    if args.profile or args.cprofile:
+        enable_profiling(args.profile, memory = args.profile_memory, cprofile_file = args.cprofile)
 
     #Subset mode is used for recovering information from an intact star file
     if args.mode == 'subset':
 
-        all_star = STAR(args.i)
+        with stage("input"):
+            all_star = load_star(args, args.i)
 
-        if args.subset.endswith(".star"):
-            sub_star = STAR(args.subset)
-            index_list = sub_star.get_index()
+        if get_file_type(args.subset) == "star":
+            with stage("subset list") as st:
+                sub_star = load_star(args, args.subset, columns = [])
+                index_list = sub_star.get_index()
+                st["rows"] = len(index_list)
 
-        elif args.subset.endswith(".cs"):
+        elif get_file_type(args.subset) == "cs":
             print_info("Cryosparc (cs) file was provided, only rlnImageName column is retrieved...")
             star_file_path = all_star.get_particles_path()
-            index_list = getImageName(args.subset, filepath = star_file_path)
+            with stage("subset list") as st:
+                index_list = getImageName(args.subset, filepath = star_file_path)
+                st["rows"] = len(index_list)
 
         else:
-            print_info("Unsupported file type, exiting...")
+            print_error("Unsupported subset file type, a star or cs file is needed: {}".format(args.subset))
 
         if not args.retain_subset_columns:
-            new_star = all_star.keep_rows(index_list, inplace = True)
-            new_star.to_star(args.o)
+            if all_star.is_streaming():
+                all_star.to_star(args.o, chunks = all_star.keep_rows(index_list), jobs = args.jobs)
+            else:
+                new_star = all_star.keep_rows(index_list, inplace = True)
+                new_star.to_star(args.o, jobs = args.jobs)
         #else:
         #    column_list = args.retain_subset_columns[0]
         #    retained_df = sub_star.keep_columns(column_list)
@@ -100,7 +388,8 @@ if __name__ == '__main__':
     # hr mode is used for running human recentering based on 2D classification job
     elif args.mode == 'hr':
         print_info("Please read instrunction.txt to get to know how to use the program.")
-        ip = STAR(args.i)
+        with stage("input"):
+            ip = load_star(args, args.i)
         if ip.get_star_version() == "3.0":
             assert (ip.has_required_columns(['rlnOriginX','rlnOriginY','rlnClassNumber',\
                 'rlnCoordinateX','rlnCoordinateY'])), "Required columns are missing from star file"
@@ -114,29 +403,77 @@ if __name__ == '__main__':
         coord_max_x = args.micsx - half_box_size
         coord_max_y = args.micsy - half_box_size
         class_nr = mrcs_dim[1]
-        dict_class_xy = relion_display_parser(args.mrcs, class_nr, scale = args.scale)
-        ip.human_recenter(coord_min_x, coord_min_y, coord_max_x, coord_max_y, dict_class_xy)
-        ip.to_star(args.o)
+        with stage("class centers"):
+            if args.clicks and os.path.exists(args.clicks):
+                dict_class_xy = load_class_centers(args.clicks)
+            else:
+                if args.auto:
+                    dict_class_xy = auto_class_centers(args.mrcs)
+                else:
+                    dict_class_xy = relion_display_parser(args.mrcs, class_nr, scale = args.scale)
+                if args.clicks:
+                    save_class_centers(dict_class_xy, args.clicks)
+        ip.human_recenter(coord_min_x, coord_min_y, coord_max_x, coord_max_y, dict_class_xy, downscale = args.downscale)
+        if args.duplicates:
+            ip.remove_duplicates(args.duplicates, score = args.keep_best, jobs = args.jobs, inplace = True)
+        ip.to_star(args.o, jobs = args.jobs)
         print_info("Done")
 
     # Info mode is used for presenting basic information of the images in the star file
     elif args.mode == "info":
-        input_star_file = SATR(args.i)
-        print_info("The toatal number of particles is:"  + input_star_file.get_particle_nr())
-        print_info("The total number of micrograph number is " + input_star_file.get_column_content('rlnMicrographName'))
-        print_info("The defocus range is" + input_star_file.get_defocus_range())
-        print_info("The pixel size of particles is " + input_star_file.get_pixel_size())
+        input_star_file = load_star(args, args.i, idx = None, chunksize = args.chunksize or 500000)
+        with stage("collect info"):
+            info = input_star_file.collect_info()
+        print_info("The total number of particles is {}".format(info["particles"]))
+        print_info("The total number of micrographs is {}".format(info["micrographs"]))
+        if "defocus" in info:
+            print_info("The defocus range is {min:.1f} - {max:.1f}, median {median:.1f}".format(**info["defocus"]))
+        print_info("The pixel size of particles is {}".format(info["pixel_size"]))
+        for k, name in (("classes", "class"), ("optics_groups", "optics group")):
+            if k in info:
+                print_info("Particles per {}: {}".format(name, ", ".join("{}: {}".format(c, n) for c, n in info[k].items())))
+        if args.o:
+            with open(args.o, "w") as fp:
+                json.dump(info, fp, indent = 1)
+            print_info("Saved to file: {}".format(args.o))
 
     # Exclude mode is used for excluding particles from input star file
     elif args.mode == "exclude":
-        micrograph_list = []
-        input_star_file = STAR(args.i)
-        input_star_header = input_star_file.get_header_content()# Column Name not included
-        for f in args.exclude[0]:
-            t = STAR(f).get_column_content('rlnMicrographName')
-            micrograph_list.extend(t)
-        new_df = input_star_file.drop_rows('rlnMicrographName', micrograph_list)    
-        df2star(new_df, args.o, input_star_header)
+        micrograph_list = set()
+        exclude = sum(args.exclude, [])
+        if args.jobs > 1:
+            # The exclude lists are read by the pool while the input star file is loaded here
+            with ProcessPoolExecutor(max_workers = args.jobs) as pool:
+                jobs = [pool.submit(get_micrograph_names, f, args.chunksize) for f in exclude]
+                with stage("input"):
+                    input_star_file = load_star(args, args.i)
+                with stage("exclude lists"):
+                    for job in jobs:
+                        micrograph_list.update(job.result())
+        else:
+            with stage("input"):
+                input_star_file = load_star(args, args.i)
+            with stage("exclude lists"):
+                for f in exclude:
+                    micrograph_list.update(get_micrograph_names(f, args.chunksize))
+        if input_star_file.is_streaming():
+            input_star_file.to_star(args.o, chunks = input_star_file.drop_rows('rlnMicrographName', micrograph_list), \
+                jobs = args.jobs)
+        else:
+            input_star_file.drop_rows('rlnMicrographName', micrograph_list, inplace = True).to_star(args.o, jobs = args.jobs)
+
+    # Batch mode writes many subsets/exclusions of the input star file, which is parsed only once
+    elif args.mode == "batch":
+        run_batch(args)
+
+    # Set mode combines the particles of many star/cs files, out of core
+    elif args.mode == "set":
+        run_set_operations(args)
 
     else:
-        print_error("Unknown mode")
\ No newline at end of file
+        print_error("Unknown mode")
+
+#Main
+
+if __name__ == '__main__':
+    main(ArgumentParse())
@@ -0,0 +1,18 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#           Shared fixtures of the tests, synthetic star/cs/mrcs files     #
+############################################################################
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(scope = "session")
+def synthetic(tmp_path_factory):
+    """synthetic(n, version) -> the files written by Benchmark.generate, made once per session"""
+    import Benchmark
+    folder = tmp_path_factory.mktemp("synthetic")
+    def make(n, version = "3.1"):
+        return Benchmark.generate(str(folder), n, version)
+    return make
@@ -0,0 +1,47 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#        BeamGroup.py end to end on beam shifts of a synthetic dataset     #
+############################################################################
+import os
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+from STAR import STAR
+
+pytest.importorskip("sklearn")
+pytest.importorskip("matplotlib")
+
+BEAMGROUP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "BeamGroup.py")
+
+@pytest.fixture
+def beam_shifts(synthetic, tmp_path):
+    """csv of the beam shifts of the micrographs of a synthetic 3.1 star file, on a 2 x 2 pattern"""
+    star_file = synthetic(2000)["star"]
+    mics = STAR(star_file).get_column_content("rlnMicrographName")
+    rng = np.random.RandomState(0)
+    shots = np.arange(len(mics)) % 4
+    xy = np.stack([shots // 2, shots % 2], axis = 1) + rng.normal(0, 0.05, (len(mics), 2))
+    csv = tmp_path / "beam_shifts.csv"
+    pd.DataFrame({"image_shift_x": xy[:, 0] * 1e-9, "image_shift_y": xy[:, 1] * 1e-9, "MicrographName": mics}).to_csv(csv, index = False)
+    return star_file, str(csv), pd.Series(shots, index = mics)
+
+def run_beamgroup(*argv):
+    subprocess.run([sys.executable, BEAMGROUP] + list(argv), check = True, env = dict(os.environ, MPLBACKEND = "Agg"))
+
+def test_optics_groups_from_beam_shifts(beam_shifts, tmp_path):
+    star_file, csv, shots = beam_shifts
+    run_beamgroup("--meta", csv, "--star", star_file, "--o", str(tmp_path / "grouped"), "--k_range", "2", "6", "--save_plot")
+    star = STAR(str(tmp_path / "grouped.star"))
+    star.load_all_columns()
+    groups = star._content.groupby(star._content["rlnMicrographName"].map(shots))["rlnOpticsGroup"].nunique()
+    assert len(star._optics_groups) == 4 and (groups == 1).all()
+    assert os.path.exists(str(tmp_path / "grouped_labeled.png"))
+
+def test_grid_groups_to_csv(beam_shifts, tmp_path):
+    _, csv, shots = beam_shifts
+    run_beamgroup("--meta", csv, "--o", str(tmp_path / "grid"), "--method", "grid", "--grid", "1")
+    for nr in range(1, 5):
+        mics = pd.read_csv(str(tmp_path / "grid.Group{}".format(nr)), header = None)[0]
+        assert shots[mics].nunique() == 1
@@ -0,0 +1,24 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#       Requests of the rockstar server, run without the socket            #
+############################################################################
+import io
+import os
+import RockClient
+import RockServer
+
+def hr_request(files, output, *extra):
+    argv = ["hr", "--i", files["star"], "--mrcs", files["mrcs"], "--micsx", "5760", "--micsy", "4092", \
+        "--auto", "--o", output] + list(extra)
+    return {"argv": argv, "cwd": os.getcwd()}
+
+def test_hr_of_relion30_needs_downscale(synthetic, tmp_path):
+    files = synthetic(10000, "3.0")
+    writer = io.StringIO()
+    assert RockServer.run_request(hr_request(files, str(tmp_path / "hr.star")), writer) != 0
+    assert "--downscale" in writer.getvalue() and not (tmp_path / "hr.star").exists()
+    assert RockServer.run_request(hr_request(files, str(tmp_path / "hr.star"), "--downscale", "2"), io.StringIO()) == 0
+    assert (tmp_path / "hr.star").exists()
+
+def test_socket_path_shared_with_client():
+    assert RockServer.get_socket_path is RockClient.get_socket_path
@@ -0,0 +1,37 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#           Binary sidecar cache of parsed star files                      #
+############################################################################
+import os
+import pandas as pd
+from STAR import STAR
+from StarCache import load_sidecar, save_sidecar, get_entry_dir
+
+def test_cached_star_file_matches_parsed(synthetic, tmp_path):
+    files = synthetic(10000)
+    parsed = STAR(files["star"])
+    STAR(files["star"], cache_dir = str(tmp_path))
+    cached = STAR(files["star"], cache_dir = str(tmp_path))
+    # The copy turns the memory-mapped columns into plain arrays
+    pd.testing.assert_frame_equal(cached._content.copy(), parsed._content, check_exact = True)
+
+def test_object_column_with_other_values(tmp_path):
+    star_file = tmp_path / "a.star"
+    star_file.write_text("data_\nloop_\n")
+    df = pd.DataFrame({"rlnImageName": ["1@a.mrcs", "2@a.mrcs"], "rlnGroupName": [1, "g2"]}).set_index("rlnImageName")
+    save_sidecar(str(star_file), str(tmp_path), {}, df)
+    assert load_sidecar(str(star_file), str(tmp_path))[1]["rlnGroupName"].tolist() == ["1", "g2"]
+
+def test_entry_filled_by_another_run(tmp_path, monkeypatch):
+    star_file = tmp_path / "a.star"
+    star_file.write_text("data_\nloop_\n")
+    df = pd.DataFrame({"rlnImageName": ["1@a.mrcs"], "rlnCoordinateX": [1.5]}).set_index("rlnImageName")
+    entry = get_entry_dir(str(star_file), str(tmp_path))
+    # The other run recreates the entry between the removal and the rename
+    rename = os.rename
+    def racing_rename(src, dst):
+        os.makedirs(os.path.join(dst, "other"))
+        return rename(src, dst)
+    monkeypatch.setattr(os, "rename", racing_rename)
+    save_sidecar(str(star_file), str(tmp_path), {}, df)
+    assert os.path.isdir(entry) and not [d for d in os.listdir(str(tmp_path)) if ".tmp" in d]
@@ -0,0 +1,62 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#          Optics blocks before and after the particles loop               #
+############################################################################
+import gzip
+import pandas as pd
+import pytest
+from StarHeader import read_star_header
+from STAR import STAR
+
+OPTICS = """
+data_optics
+
+loop_
+_rlnOpticsGroupName #1
+_rlnOpticsGroup #2
+_rlnMicrographOriginalPixelSize #3
+_rlnVoltage #4
+_rlnSphericalAberration #5
+_rlnAmplitudeContrast #6
+_rlnImagePixelSize #7
+_rlnImageSize #8
+_rlnImageDimensionality #9
+opticsGroup1  1  0.830000  300.000000  2.700000  0.100000  1.660000  128  2
+opticsGroup2  2  0.830000  300.000000  2.700000  0.100000  3.320000  64  2
+
+"""
+
+PARTICLES = """
+data_particles
+
+loop_
+_rlnImageName #1
+_rlnCoordinateX #2
+_rlnOpticsGroup #3
+""" + "".join("{:06d}@Extract/stack.mrcs {:.6f} {}\n".format(i + 1, 10.5 * i, i % 2 + 1) for i in range(10)) + "\n"
+
+def write(tmp_path, name, text):
+    filename = str(tmp_path / name)
+    with (gzip.open(filename, "wt") if name.endswith(".gz") else open(filename, "w")) as fp:
+        fp.write(text)
+    return filename
+
+@pytest.mark.parametrize("name", ["optics_last.star", "optics_last.star.gz"])
+@pytest.mark.parametrize("chunksize", [None, 3])
+def test_optics_after_particles(tmp_path, name, chunksize):
+    filename = write(tmp_path, name, "\n# version 30001\n" + PARTICLES + "\n# version 30001\n" + OPTICS)
+    # Not looked for by default, RELION writes the optics block first
+    assert read_star_header(filename)["version"] == "3.0"
+    header = read_star_header(filename, optics_after = True)
+    assert header["version"] == "3.1" and len([ln for ln in header["optics"] if not ln.startswith("_")]) == 2
+    star = STAR(filename, chunksize = chunksize, optics_after = True)
+    content = pd.concat(list(star.iter_chunks()))
+    assert content.shape == (10, 2)
+    assert content["rlnCoordinateX"].tolist() == [10.5 * i for i in range(10)]
+
+def test_last_optics_group_stands_for_the_dataset(tmp_path):
+    filename = write(tmp_path, "optics_first.star", "\n# version 30001\n" + OPTICS + "\n# version 30001\n" + PARTICLES)
+    star = STAR(filename)
+    assert read_star_header(filename)["particles_end"] is None
+    assert star.get_optics_values("rlnImagePixelSize") == 3.32 and star.get_image_apix() == 3.32
+    assert star.get_optics_values("rlnImagePixelSize", star._content["rlnOpticsGroup"].to_numpy()).tolist() == [1.66, 3.32] * 5
@@ -0,0 +1,22 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#          gzip/zstd star files written and read back by rockstar          #
+############################################################################
+import pandas as pd
+import pytest
+from StarHeader import read_star_header
+from STAR import STAR
+
+@pytest.mark.parametrize("suffix", [".gz", ".zst"])
+def test_compressed_round_trip(synthetic, tmp_path, suffix):
+    if suffix == ".zst":
+        pytest.importorskip("zstandard")
+    files = synthetic(10000)
+    star = STAR(files["star"])
+    output = str(tmp_path / ("particles.star" + suffix))
+    star.to_star(output)
+    header = read_star_header(output)
+    assert header["version"] == "3.1" and header["particles_columns"] == star._particles_columns
+    pd.testing.assert_frame_equal(STAR(output)._content, star._content, check_exact = True)
+    chunks = pd.concat(list(STAR(output, chunksize = 3000).iter_chunks()))
+    pd.testing.assert_frame_equal(chunks, star._content, check_exact = True)
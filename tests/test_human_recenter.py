@@ -0,0 +1,51 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#      human_recenter against the original loop over the particles         #
+############################################################################
+import pytest
+from pandas.testing import assert_frame_equal
+from RelionTools import get_offset_xy
+from STAR import STAR
+
+DOWNSCALE = 2
+CLICKS = {"1": (1.5, -2.0), "3": (-4.0, 0.5), "7": (0.0, 3.25)}
+BOX = (64, 64, 5760 - 64, 4092 - 64)
+
+def human_recenter_original(star, minx, miny, maxx, maxy, d):
+    """The iterrows loop human_recenter had before it was vectorized, returns the recentered rows"""
+    df = star._content[star._content.rlnClassNumber.isin([int(key) for key in d.keys()])].copy()
+    if star.get_star_version() == "3.0":
+        downscale_factor, image_apix, origins = DOWNSCALE, 1.0, ["rlnOriginX", "rlnOriginY"]
+    else:
+        downscale_factor, image_apix, origins = star._downscale_factor, star._image_apix, ["rlnOriginXAngst", "rlnOriginYAngst"]
+    for idx, row in df.iterrows():
+        cls_number = str(row['rlnClassNumber'])
+        offsets = get_offset_xy(row['rlnAnglePsi'], d[cls_number][0] * downscale_factor, d[cls_number][1] * downscale_factor)
+        row['rlnCoordinateX'] -= row[origins[0]] / image_apix + offsets[0]
+        row['rlnCoordinateX'] = min(maxx, max(minx, row['rlnCoordinateX']))
+        df.loc[idx,"rlnCoordinateX"] = row["rlnCoordinateX"]
+        row['rlnCoordinateY'] -= row[origins[1]] / image_apix + offsets[1]
+        row['rlnCoordinateY'] = min(maxy, max(miny, row['rlnCoordinateY']))
+        df.loc[idx,"rlnCoordinateY"] = row["rlnCoordinateY"]
+    df[origins] = 0.0
+    return df
+
+@pytest.mark.parametrize("version", ["3.1", "3.0"])
+def test_human_recenter_matches_original(synthetic, version):
+    star_file = synthetic(5000, version)["star"]
+    star = STAR(star_file)
+    star.load_all_columns()
+    expected = human_recenter_original(star, *BOX, CLICKS)
+    recentered = STAR(star_file).human_recenter(*BOX, CLICKS, inplace = False, downscale = DOWNSCALE)
+    assert len(expected) > 0
+    assert_frame_equal(recentered, expected[recentered.columns], check_dtype = False)
+
+def test_human_recenter_after_assigning_optics_groups(synthetic):
+    star = STAR(synthetic(5000)["star"])
+    shared = star.copy()
+    mics = star._content["rlnMicrographName"].unique()
+    star.assign_optics_groups({mic: nr % 3 for nr, mic in enumerate(mics)})
+    assert len(star._optics_groups) == 3 and star._ctf["rlnOpticsGroup"] == "3"
+    assert (shared._content["rlnOpticsGroup"] == 1).all()
+    recentered = star.human_recenter(*BOX, CLICKS, inplace = False)
+    assert len(recentered) > 0
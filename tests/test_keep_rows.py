@@ -0,0 +1,29 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#       keep_rows on subsets, against .loc of the original code            #
+############################################################################
+import numpy as np
+import pandas as pd
+import pytest
+from STAR import STAR
+
+# Two particles expanded 4 times each, e.g. by relion_particle_symmetry_expand
+EXPANDED = "\n# version 30001\n\ndata_particles\n\nloop_\n_rlnImageName #1\n_rlnAnglePsi #2\n" + \
+    "".join("{:06d}@s.mrcs {:.1f}\n".format(i % 2 + 1, 10.0 * i) for i in range(8)) + "\n"
+
+@pytest.mark.parametrize("chunksize", [None, 3])
+def test_keep_rows_repeated_names(tmp_path, chunksize):
+    filename = str(tmp_path / "expanded.star")
+    with open(filename, "w") as fp:
+        fp.write(EXPANDED)
+    expected = STAR(filename)._content.loc[["000001@s.mrcs"]]
+    star = STAR(filename, chunksize = chunksize)
+    kept = star.keep_rows(["000001@s.mrcs"])
+    kept = pd.concat(list(kept)) if chunksize else kept
+    assert len(kept) == 4
+    pd.testing.assert_frame_equal(kept, expected)
+
+def test_keep_rows_matches_loc(synthetic):
+    star = STAR(synthetic(5000)["star"])
+    names = np.random.RandomState(0).permutation(star._content.index.to_numpy())[:1000].tolist()
+    pd.testing.assert_frame_equal(star.keep_rows(names), star._content.loc[names])
@@ -0,0 +1,40 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#       Columns parsed on demand after opening with columns                #
+############################################################################
+import pandas as pd
+import pytest
+from STAR import STAR
+
+# Two particles expanded 4 times each, e.g. by relion_particle_symmetry_expand
+EXPANDED = "\n# version 30001\n\ndata_particles\n\nloop_\n_rlnImageName #1\n_rlnAnglePsi #2\n_rlnClassNumber #3\n" + \
+    "".join("{:06d}@s.mrcs {:.1f} {}\n".format(i % 2 + 1, 10.0 * i, i // 2 + 1) for i in range(8)) + "\n"
+
+@pytest.fixture
+def expanded(tmp_path):
+    filename = str(tmp_path / "expanded.star")
+    with open(filename, "w") as fp:
+        fp.write(EXPANDED)
+    return filename
+
+@pytest.mark.parametrize("cache", [False, True])
+def test_load_columns_of_repeated_names(expanded, tmp_path, monkeypatch, cache):
+    cache_dir = str(tmp_path / "cache") if cache else None
+    full = STAR(expanded, cache_dir = cache_dir)._content
+    star = STAR(expanded, columns = ["rlnClassNumber"], cache_dir = cache_dir)
+    if cache:
+        # The cached columns are read instead of parsing the star file again
+        monkeypatch.setattr(STAR, "_read_particles", None)
+    star.load_all_columns()
+    # The copy turns the memory-mapped columns into plain arrays
+    pd.testing.assert_frame_equal(star._content.copy(), full)
+
+def test_load_columns_after_removing_rows(expanded):
+    full = STAR(expanded)._content
+    star = STAR(expanded, columns = ["rlnClassNumber"])
+    star.keep_rows(["000002@s.mrcs"], inplace = True)
+    pd.testing.assert_frame_equal(star.load_all_columns()._content, full.loc[["000002@s.mrcs"]])
+    star = STAR(expanded, columns = ["rlnClassNumber"])
+    star.drop_rows("rlnClassNumber", [2], inplace = True)
+    with pytest.raises(SystemExit):
+        star.load_all_columns()
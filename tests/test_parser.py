@@ -0,0 +1,35 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#           The particles loop parser against the original parser          #
+############################################################################
+import gzip
+import shutil
+import time
+import pandas as pd
+import pytest
+from STAR import STAR
+
+def read_particles_original(star):
+    """The particles loop parsed the way STAR did before the C tokenizer and the label dtypes"""
+    return pd.read_csv(star._filename, sep = r'\s+', skiprows = star._particle_start_nr, \
+        names = star._particles_columns, skipinitialspace = True, skip_blank_lines = True, index_col = "rlnImageName")
+
+@pytest.mark.parametrize("version", ["3.1", "3.0"])
+def test_parser_matches_original(synthetic, version, capsys):
+    files = synthetic(1000000, version)
+    t0 = time.perf_counter()
+    star = STAR(files["star"])
+    t1 = time.perf_counter()
+    original = read_particles_original(star)
+    t2 = time.perf_counter()
+    # Same values, dtypes, columns and index
+    pd.testing.assert_frame_equal(star._content, original, check_exact = True)
+    with capsys.disabled():
+        print("\nRELION {}, 1000000 particles: parser {:.2f}s, original parser {:.2f}s".format(version, t1 - t0, t2 - t1))
+
+def test_parser_matches_original_compressed(synthetic):
+    files = synthetic(10000)
+    with open(files["star"], "rb") as src, gzip.open(files["star"] + ".gz", "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    star = STAR(files["star"])
+    pd.testing.assert_frame_equal(STAR(files["star"] + ".gz")._content, read_particles_original(star), check_exact = True)
@@ -0,0 +1,44 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#             Command lines of rockstar.py on synthetic files              #
+############################################################################
+import gzip
+import shutil
+import numpy as np
+import pytest
+import rockstar
+
+def run(*argv):
+    rockstar.main(rockstar.ArgumentParse(list(argv)))
+
+def test_subset_compressed_star(synthetic, tmp_path):
+    files = synthetic(10000)
+    subset = str(tmp_path / "subset.star.gz")
+    with open(files["subset_star"], "rb") as src, gzip.open(subset, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    run("subset", "--i", files["star"], "--subset", files["subset_star"], "--o", str(tmp_path / "plain.star"))
+    run("subset", "--i", files["star"], "--subset", subset, "--o", str(tmp_path / "gz.star"))
+    assert (tmp_path / "gz.star").read_text() == (tmp_path / "plain.star").read_text()
+
+def test_subset_unsupported_file_type(synthetic, tmp_path):
+    files = synthetic(10000)
+    with pytest.raises(SystemExit):
+        run("subset", "--i", files["star"], "--subset", str(tmp_path / "subset.txt"), "--o", str(tmp_path / "out.star"))
+    assert not (tmp_path / "out.star").exists()
+
+def test_image_names_of_empty_cs(synthetic, tmp_path):
+    files = synthetic(10000)
+    cs = np.load(files["subset_cs"])
+    np.save(str(tmp_path / "empty.npy"), cs[:0])
+    assert rockstar.getImageName(str(tmp_path / "empty.npy"), "Extract") == []
+    assert rockstar.getImageName(files["subset_cs"], "Extract")[:1] == \
+        ["{:06d}@Extract/{}".format(int(cs["blob/idx"][0]) + 1, cs["blob/path"][0].decode("utf-8").split("/")[-1])]
+
+def test_exclude_flags_given_twice(synthetic, tmp_path):
+    files = synthetic(10000)
+    run("exclude", "--i", files["star"], "--exclude", files["exclude"], files["subset_star"], "--o", str(tmp_path / "one.star"))
+    run("exclude", "--i", files["star"], "--exclude", files["exclude"], "--exclude", files["subset_star"], \
+        "--o", str(tmp_path / "two.star"))
+    run("exclude", "--i", files["star"], "--exclude", files["exclude"], "--o", str(tmp_path / "first.star"))
+    assert (tmp_path / "two.star").read_text() == (tmp_path / "one.star").read_text()
+    assert len((tmp_path / "two.star").read_text()) < len((tmp_path / "first.star").read_text())
@@ -0,0 +1,30 @@
+############################################################################
+#   Written by Zhuang Li, Purdue University. Last modified at 2021-03-13   #
+#        Star files written in chunks against written at once              #
+############################################################################
+import pytest
+from Benchmark import OPTICS_31
+from STAR import STAR
+
+COLUMNS = ["rlnImageName", "rlnCoordinateX", "rlnOriginXAngst", "rlnDefocusAngle", "rlnClassNumber", "MyScore"]
+# rlnOriginXAngst is 0 in the first chunks only, rlnDefocusAngle gets too small for 6 decimals later
+# and the unknown MyScore turns from whole numbers to fractions
+ROWS = [("{:06d}@Extract/stack.mrcs".format(i + 1), 100.25 + i, "0" if i < 4 else "1.5", \
+         "2.1909866" if i < 7 else "0.0000123", str(i % 3 + 1), str(i) if i < 5 else "{}.25".format(i)) for i in range(10)]
+
+@pytest.fixture
+def star_file(tmp_path):
+    filename = tmp_path / "particles.star"
+    with open(filename, "w") as fp:
+        fp.write(OPTICS_31.format(128) + "\ndata_particles\n\nloop_\n")
+        fp.write("".join("_{} #{}\n".format(col, i + 1) for i, col in enumerate(COLUMNS)))
+        fp.write("".join(" ".join(map(str, row)) + "\n" for row in ROWS))
+    return str(filename)
+
+@pytest.mark.parametrize("chunksize", [1, 3, 4])
+def test_chunked_output_matches_unchunked(star_file, tmp_path, chunksize):
+    STAR(star_file).to_star(str(tmp_path / "whole.star"))
+    STAR(star_file, chunksize = chunksize).to_star(str(tmp_path / "chunked.star"))
+    whole = (tmp_path / "whole.star").read_text()
+    assert (tmp_path / "chunked.star").read_text() == whole
+    assert " 1.500000 " in whole and " 1.23e-05 " in whole and " 1 0\n" in whole and " 5.250000\n" in whole